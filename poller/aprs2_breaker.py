@@ -0,0 +1,99 @@
+
+"""
+
+Circuit breaker for servers which are down hard.
+
+After a number of consecutive polls have failed to connect to a server,
+the breaker opens, and only a cheap TCP connect check is done, with an
+exponentially increasing interval, until the server responds again.
+Then the full poll resumes.
+
+"""
+
+import threading
+import time
+
+# breaker states returned by check()
+CLOSED = 'closed'
+PROBE = 'probe'
+SKIP = 'skip'
+
+class CircuitBreaker:
+    def __init__(self, log, threshold=5, backoff_min=300, backoff_max=3600):
+        self.log = log
+        self.threshold = threshold
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        
+        # server id => state
+        self.states = {}
+        self.lock = threading.Lock()
+    
+    def check(self, id, now=None):
+        """
+        Figure out what to do with a server: full poll (CLOSED),
+        cheap connect check (PROBE) or nothing at all (SKIP)
+        """
+        if now == None:
+            now = time.time()
+        
+        with self.lock:
+            st = self.states.get(id)
+            if st == None or not st['open']:
+                return CLOSED
+            
+            if now < st['next_probe']:
+                return SKIP
+            
+            return PROBE
+    
+    def last_errors(self, id):
+        """
+        Get the errors of the last poll which did run, for a server
+        """
+        with self.lock:
+            st = self.states.get(id)
+            if st == None:
+                return []
+            
+            return list(st['errors'])
+    
+    def record(self, id, connect_failed, errors, now=None):
+        """
+        Record the result of a poll or connect check
+        """
+        if now == None:
+            now = time.time()
+        
+        with self.lock:
+            st = self.states.get(id)
+            
+            if not connect_failed:
+                if st != None:
+                    if st['open']:
+                        self.log.info("%s: Circuit breaker closed, server responds again", id)
+                    del self.states[id]
+                return
+            
+            if st == None:
+                st = self.states[id] = {
+                    'failures': 0,
+                    'open': False,
+                    'backoff': 0,
+                    'next_probe': 0
+                }
+            
+            st['failures'] += 1
+            st['errors'] = list(errors)
+            
+            if st['open']:
+                st['backoff'] = min(st['backoff'] * 2, self.backoff_max)
+            elif st['failures'] >= self.threshold:
+                st['open'] = True
+                st['backoff'] = self.backoff_min
+                self.log.info("%s: Circuit breaker opened after %d consecutive connect failures", id, st['failures'])
+            else:
+                return
+            
+            st['next_probe'] = now + st['backoff']
+            self.log.info("%s: Circuit breaker open, next connect check in %d s", id, st['backoff'])
@@ -16,6 +16,30 @@ class aprs2cf:
             'aprs2.net': 'd7c9ec1d772da32eefdb89f962788913',
         }
         
+    def list_records(self, zone, per_page = 5000):
+        """
+        Get all records of a zone, in as few requests as possible.
+        Returns None if the listing fails.
+        """
+        zone_id = self.zone_ids[zone]
+        
+        records = []
+        page = 1
+        while True:
+            try:
+                l = self.cf.zones.dns_records.get(zone_id, params={"page": page, "per_page": per_page})
+            except CloudFlare.exceptions.CloudFlareAPIError as e:
+                self.log.error("Failed to list CF DNS records of zone %s: %d %s", zone, e, e)
+                return None
+            
+            records.extend(l)
+            if len(l) < per_page:
+                break
+            page += 1
+        
+        self.log.info("Listed %d records in zone %s", len(records), zone)
+        return records
+    
     def dns_push(self, logid, zone, fqdn, v4_addrs = [], v6_addrs = [], cname = None):
         use_zone = zone
         zone_id = self.zone_ids[use_zone]
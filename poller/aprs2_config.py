@@ -13,6 +13,8 @@ import threading
 import time
 import random
 import re
+import socket
+import ipaddress
 
 POLL_INTERVAL = 2*60
 
@@ -43,8 +45,99 @@ test_setup = {
     },
 }
 
+def pack_address(addr):
+    """
+    Convert a textual IPv4 or IPv6 address to its packed binary form,
+    or None if it's not a valid address
+    """
+    for af in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(af, addr)
+        except (socket.error, ValueError):
+            pass
+    
+    return None
+
+def pack_address_port(addr):
+    """
+    Convert an "address:port" or "[address]:port" string to a packed address
+    """
+    host, sep, port = addr.rpartition(':')
+    if not sep or not port.isdigit():
+        host = addr
+    
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    
+    return pack_address(host)
+
+class AddressIndex:
+    """
+    Map uplink addresses to server IDs. The index is keyed by the packed
+    binary form of the address, so the textual form of IPv6 addresses does
+    not matter. Optional prefixes ("192.0.2.0/24" => server id) match servers
+    whose uplink connections are seen coming from a NAT or an alternate address.
+    """
+    def __init__(self, address_map, prefixes={}):
+        self.exact = {}
+        for addr in address_map:
+            packed = pack_address(addr)
+            if packed != None:
+                self.exact[packed] = address_map[addr]
+        
+        # (address length, prefix length, network as integer, server id), longest prefix first
+        self.prefixes = []
+        for prefix in prefixes:
+            net = ipaddress.ip_network(prefix, strict=False)
+            self.prefixes.append((net.max_prefixlen // 8, net.prefixlen, int(net.network_address), prefixes[prefix]))
+        self.prefixes.sort(key=lambda x: x[1], reverse=True)
+    
+    def lookup(self, addr):
+        """
+        Look up the server ID of an "address:port" string. Returns "unknown"
+        if the address cannot be parsed, None if no server matches.
+        """
+        packed = pack_address_port(addr)
+        if packed == None:
+            return "unknown"
+        
+        id = self.exact.get(packed)
+        if id != None or not self.prefixes:
+            return id
+        
+        n = int.from_bytes(packed, 'big')
+        bits = len(packed) * 8
+        for alen, plen, net, id in self.prefixes:
+            if alen == len(packed) and n >> (bits - plen) == net >> (bits - plen):
+                return id
+        
+        return None
+
+class ConfigSnapshot:
+    """
+    In-memory copy of the server configuration: servers, address map
+    and rotate membership. A snapshot is never modified after it has
+    been created - when the configuration version changes, a new snapshot
+    is loaded and swapped in place of the old one.
+    """
+    def __init__(self, version, servers, address_map, rotates, address_index=None):
+        self.version = version
+        self.servers = servers
+        self.address_map = address_map
+        self.rotates = rotates
+        self.address_index = address_index if address_index != None else AddressIndex(address_map)
+        
+        # rotate id => set of member server ids
+        self.rotate_members = dict([(rid, frozenset(rotates[rid].get('members', []))) for rid in rotates])
+    
+    def getServer(self, id):
+        """
+        Get a single server configuration
+        """
+        return self.servers.get(id)
+
 class ConfigManager:
-    def __init__(self, log, red, portal_servers_url, portal_rotates_url, unmanaged_rotates = {}, credentials = None):
+    def __init__(self, log, red, portal_servers_url, portal_rotates_url, unmanaged_rotates = {}, credentials = None, address_prefixes = {}):
         self.log = log
         self.red = red
         
@@ -56,6 +149,8 @@ class ConfigManager:
         self.config_etag = None
         self.unmanaged_rotates = unmanaged_rotates
         self.client_credentials = credentials
+        # additional address prefix => server id mappings for uplink lookup
+        self.address_prefixes = address_prefixes
         
         self.shutdown = False
         
@@ -266,8 +361,32 @@ class ConfigManager:
         
         # TODO: add sanity check for too few servers
         self.red.setAddressMap(addr_map)
-        self.log.info("Applied new server configuration")
         self.pollq_cleanup(polled)
+        
+        # Tell pollers to load a new config snapshot
+        version = self.red.bumpConfigVersion()
+        self.log.info("Applied new server configuration, version %d", version)
+    
+    def load_snapshot(self):
+        """
+        Load an in-memory snapshot of the current configuration from the database
+        """
+        
+        version, servers, addr_map, rotates = self.red.getConfigSet()
+        self.log.info("Loaded config snapshot version %r: %d servers, %d rotates", version, len(servers), len(rotates))
+        
+        return ConfigSnapshot(version, servers, addr_map, rotates, self.build_address_index(addr_map))
+    
+    def build_address_index(self, addr_map):
+        """
+        Build a binary address => server ID index for uplink lookups
+        """
+        
+        try:
+            return AddressIndex(addr_map, self.address_prefixes)
+        except ValueError as e:
+            self.log.error("Invalid uplink address prefix configuration: %s", e)
+            return AddressIndex(addr_map)
     
     def pollq_cleanup(self, polled):
         """
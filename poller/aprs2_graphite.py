@@ -1,13 +1,153 @@
 
 import queue
 import threading
+import time
+import os
+import math
 
 import graphitesend
 
+import aprs2_metrics
+
 # don't hold a massive backlog, just momentary spikes
 max_queue_size = 500
 
+# send metrics in batches of up to this many, at least every flush_interval seconds
+batch_size = 200
+flush_interval = 1.0
+
+# On-disk spool for metrics which could not be sent while Graphite is
+# unreachable; replayed after reconnecting, at most replay_rate metrics/s.
+# Set up with configure(). None: no spooling, metrics are dropped.
+spool_path = None
+spool_max_bytes = 50*1024*1024
+replay_rate = 1000
+
+# reconnect backoff, seconds
+reconnect_min = 5
+reconnect_max = 300
+
 g_thread = None
+g_thread_lock = threading.Lock()
+
+def configure(spool=None, spool_max=None, rate=None):
+    """
+    Configure the Graphite sender, before sending anything
+    """
+    global spool_path, spool_max_bytes, replay_rate
+    
+    spool_path = spool or None
+    if spool_max != None:
+        spool_max_bytes = spool_max
+    if rate != None:
+        replay_rate = rate
+
+def queue_depth():
+    return g_thread.queue.qsize() if g_thread != None else 0
+
+def queue_dropped():
+    return g_thread.queue_dropped if g_thread != None else 0
+
+def spool_counter(name):
+    if g_thread == None or g_thread.spool == None:
+        return 0
+    return getattr(g_thread.spool, name)
+
+def register_metrics():
+    """
+    Expose the sender's queue and spool state as metrics
+    """
+    aprs2_metrics.gauge('aprs2_graphite_queue', 'Graphite metrics queued for sending', func=queue_depth)
+    aprs2_metrics.counter('aprs2_graphite_queue_dropped', 'Graphite metrics dropped due to a full queue', func=queue_dropped)
+    aprs2_metrics.counter('aprs2_graphite_spooled', 'Graphite metrics spooled to disk', func=lambda: spool_counter('spooled'))
+    aprs2_metrics.counter('aprs2_graphite_replayed', 'Graphite metrics replayed from the spool', func=lambda: spool_counter('replayed'))
+    aprs2_metrics.counter('aprs2_graphite_spool_dropped', 'Graphite metrics dropped due to a full spool', func=lambda: spool_counter('dropped'))
+
+class GraphiteSpool(object):
+    """
+    Append-only spool file of metrics, in Graphite plaintext format.
+    Replayed from the beginning, and truncated once everything has been replayed.
+    """
+    def __init__(self, log, path, max_bytes):
+        self.log = log
+        self.path = path
+        self.max_bytes = max_bytes
+        
+        # replay position
+        self.offset = 0
+        
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        
+        try:
+            self.size = os.path.getsize(self.path)
+        except OSError:
+            self.size = 0
+        
+        if self.size > 0:
+            self.log.info("Graphite spool %s has %d bytes to replay", self.path, self.size)
+    
+    def pending(self):
+        return self.offset < self.size
+    
+    def append(self, batch):
+        """
+        Store a batch of (metric, value, timestamp) tuples. The values have
+        been checked to be finite floats by GraphiteSender.send.
+        """
+        d = ''.join(['%s %r %d\n' % (metric, value, timestamp) for metric, value, timestamp in batch]).encode('utf-8')
+        
+        if self.size + len(d) > self.max_bytes:
+            self.dropped += len(batch)
+            return False
+        
+        try:
+            with open(self.path, 'ab') as f:
+                f.write(d)
+        except (IOError, OSError) as e:
+            self.log.error("Graphite spool write failed: %r", e)
+            self.dropped += len(batch)
+            return False
+        
+        self.size += len(d)
+        self.spooled += len(batch)
+        return True
+    
+    def read(self, count):
+        """
+        Read up to count metrics from the replay position.
+        Returns the metrics, and the position to commit() after they've been sent.
+        """
+        batch = []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            offset = self.offset
+            while len(batch) < count:
+                l = f.readline()
+                if not l or not l.endswith(b'\n'):
+                    break
+                offset += len(l)
+                try:
+                    metric, value, timestamp = l.decode('utf-8').split()
+                    batch.append((metric, float(value), int(timestamp)))
+                except ValueError:
+                    self.log.error("Graphite spool: invalid line skipped: %r", l)
+        
+        return batch, offset
+    
+    def commit(self, offset, count):
+        """
+        Mark metrics up to offset as sent, truncate the spool when all done
+        """
+        self.offset = offset
+        self.replayed += count
+        
+        if self.offset >= self.size:
+            self.log.info("Graphite spool replayed, truncating")
+            with open(self.path, 'wb'):
+                pass
+            self.offset = self.size = 0
 
 class GraphiteThread(object):
     def __init__(self, log):
@@ -15,50 +155,112 @@ class GraphiteThread(object):
         self.graphite = None
         self.thr = None
         
+        # reconnect backoff state
+        self.connect_failed = False
+        self.connect_next_t = 0
+        self.connect_backoff = reconnect_min
+        
+        # metrics dropped due to a full queue, updated by all sending threads
+        self.queue_dropped = 0
+        self.queue_dropped_lock = threading.Lock()
         
         self.queue = queue.Queue(max_queue_size)
         self.stopping = threading.Event()
         
-        self.check_connect()
+        self.spool = None
+        if spool_path:
+            self.spool = GraphiteSpool(log, spool_path, spool_max_bytes)
         
+        # the consumer thread connects, so that the caller won't block
         t = threading.Thread(target = self.__consume)
         t.daemon = True
         t.start()
         
     def check_connect(self):
         if self.graphite == None or self.graphite.socket == None:
+            now = time.time()
+            if now < self.connect_next_t:
+                return
+            
             try:
                 self.log.info("Connecting to Graphite")
                 self.graphite = graphitesend.GraphiteClient(fqdn_squash=True, graphite_server='t2graph.aprs2.net', graphite_port=2003)
             except Exception as e:
-                self.log.error("Failed to connect to Graphite: %r" % e)
+                self.graphite = None
+                self.connect_failed = True
+                self.connect_next_t = now + self.connect_backoff
+                self.log.error("Failed to connect to Graphite, retrying in %d s: %r", self.connect_backoff, e)
+                self.connect_backoff = min(self.connect_backoff * 2, reconnect_max)
                 return
+            
+            self.connect_failed = False
+            self.connect_backoff = reconnect_min
     
     def __consume(self):
+        batch = []
+        flush_t = time.time() + flush_interval
+        
         while not self.stopping.is_set():
             try:
-                item = self.queue.get(block = True, timeout = 1)
-                self.check_connect()
-                
-                metric, value = item
-                self.transmit(metric, value)
-                
+                # wait for the first item until it's time to flush,
+                # then drain whatever else is queued right now
+                item = self.queue.get(block = True, timeout = max(0.01, flush_t - time.time()))
+                batch.append(item)
                 self.queue.task_done()
+                
+                while len(batch) < batch_size:
+                    batch.append(self.queue.get_nowait())
+                    self.queue.task_done()
             except queue.Empty:
                 pass
-            except Exception as e:
-                import traceback
-                self.log.error("GraphiteThread: %s", traceback.format_exc())
-                self.queue.task_done()
+            
+            now = time.time()
+            if len(batch) >= batch_size or now >= flush_t:
+                flush_t = now + flush_interval
+                try:
+                    if batch or self.connect_failed or (self.spool and self.spool.pending()):
+                        self.check_connect()
+                    
+                    if batch:
+                        if not self.transmit(batch) and self.spool:
+                            self.spool.append(batch)
+                    
+                    if self.graphite != None and self.spool and self.spool.pending():
+                        self.replay()
+                except Exception as e:
+                    import traceback
+                    self.log.error("GraphiteThread: %s", traceback.format_exc())
+                batch = []
                 
         self.log.debug("GraphiteThread stopping")
 
-    def transmit(self, metric, value):
+    def replay(self):
+        """
+        Send some of the spooled metrics, rate limited
+        """
+        count = max(1, int(replay_rate * flush_interval))
+        while count > 0 and self.spool.pending():
+            batch, offset = self.spool.read(min(count, batch_size))
+            if not batch:
+                # nothing readable left
+                self.spool.commit(self.spool.size, 0)
+                return
+            
+            if not self.transmit(batch):
+                return
+            
+            self.spool.commit(offset, len(batch))
+            count -= len(batch)
+    
+    def transmit(self, batch):
+        """
+        Send a batch of (metric, value, timestamp) tuples in a single write
+        """
         if self.graphite == None:
-            return
+            return False
             
         try:
-            self.graphite.send(metric, value)
+            self.graphite.send_list(batch)
         except graphitesend.GraphiteSendException:
             self.log.exception("Graphite send failed")
             try:
@@ -66,14 +268,21 @@ class GraphiteThread(object):
             except Exception:
                 pass
             self.graphite = None
+            return False
+        
+        return True
 
 class GraphiteSender(object):
-    def __init__(self, log, fqdn):
+    def __init__(self, log, fqdn, timestamp=None):
         self.log = log
         
+        # timestamp for the metrics sent (default: time of sending)
+        self.timestamp = timestamp
+        
         global g_thread
-        if g_thread == None:
-            g_thread = GraphiteThread(log)
+        with g_thread_lock:
+            if g_thread == None:
+                g_thread = GraphiteThread(log)
         
         # remove domain from fqdn
         hostname = fqdn
@@ -83,16 +292,42 @@ class GraphiteSender(object):
         
         self.hostname = hostname
 
-    def send(self, metric, value):
+    def send(self, metric, value, timestamp=None):
+        """
+        Queue a metric for sending. Never blocks: if the queue is full,
+        the metric is dropped and counted.
+        """
         global g_thread
-        if g_thread.graphite == None:
-            # don't even queue
-            return
+        if g_thread.connect_failed and g_thread.spool == None:
+            # don't even queue, nowhere to put it
+            return False
 
+        # a missing value is simply not sent
+        if value == None:
+            return False
+        
+        # a bad value would make the whole batch fail later, in sending,
+        # spooling or replaying, drop just this one
+        try:
+            f = float(value)
+        except (TypeError, ValueError):
+            f = None
+        if f == None or math.isnan(f) or math.isinf(f):
+            self.log.error("GraphiteSender: %s.%s: invalid value %r dropped", self.hostname, metric, value)
+            return False
+        value = f
+        
+        if timestamp == None:
+            timestamp = self.timestamp if self.timestamp != None else time.time()
+        
         try:
-            g_thread.queue.put(('aprs2.%s.%s' % (self.hostname, metric), value), block = True, timeout = 0.1)
+            g_thread.queue.put_nowait(('aprs2.%s.%s' % (self.hostname, metric), value, timestamp))
             return True
-        except Queue.Full:
-            self.log.error("GraphiteSender: queue full")
+        except queue.Full:
+            with g_thread.queue_dropped_lock:
+                g_thread.queue_dropped += 1
+                dropped = g_thread.queue_dropped
+            if dropped % 100 == 1:
+                self.log.error("GraphiteSender: queue full, %d metrics dropped so far", dropped)
             return False
 
@@ -7,31 +7,55 @@ using the given regular logger, but also buffers all the log messages
 
 It's used for storing per-server polling log records.
 
+Messages are kept unformatted in a ring buffer, and only formatted when
+the buffer is retrieved. Note that the arguments are referenced, not
+copied, so a mutable argument will be formatted as it is at that time.
+
 """
 
 import logging
+import time
+import sys
+from collections import deque
 
 FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
 class PollingLog:
-    def __init__(self, log, bufLen=1000):
+    def __init__(self, log, bufLen=1000, level=logging.DEBUG):
         self.log = log
-        self.buf = []
+        self.buf = deque(maxlen=bufLen)
         self.buf_formatter = logging.Formatter(FORMAT, None)
+        # minimum level of messages stored in the buffer
+        self.level = level
     
     def do_append(self, level, msg, *args, **kwargs):
         """
-        Format and buffer a log record.
+        Buffer a log record, to be formatted later.
         """
-        record = self.log.makeRecord("poller", level, "(fn)", 0, msg, args, None, "()", None)
-        s = self.buf_formatter.format(record)
-        self.buf.append(s)
+        if level < self.level:
+            return
+        
+        exc_info = kwargs.get('exc_info')
+        if exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        
+        self.buf.append((time.time(), level, msg, args, exc_info))
     
     def buffer_string(self):
         """
         Returns buffered log as a string.
         """
-        return "\n".join(self.buf) + "\n"
+        lines = []
+        for t, level, msg, args, exc_info in list(self.buf):
+            record = self.log.makeRecord("poller", level, "(fn)", 0, msg, args, exc_info, "()", None)
+            record.created = t
+            record.msecs = (t - int(t)) * 1000
+            try:
+                lines.append(self.buf_formatter.format(record))
+            except Exception as e:
+                lines.append("Log formatting failed: %r: %r" % (msg, e))
+        
+        return "\n".join(lines) + "\n"
         
     def debug(self, msg, *args, **kwargs):
         self.do_append(logging.DEBUG, msg, *args, **kwargs)
@@ -50,7 +74,8 @@ class PollingLog:
         self.log.error(msg, *args, **kwargs)
     
     def exception(self, msg, *args, **kwargs):
-        self.do_append(logging.EXCEPTION, msg, *args, **kwargs)
+        kwargs.setdefault('exc_info', True)
+        self.do_append(logging.ERROR, msg, *args, **kwargs)
         self.log.exception(msg, *args, **kwargs)
     
     def critical(self, msg, *args, **kwargs):
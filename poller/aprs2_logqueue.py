@@ -0,0 +1,80 @@
+
+"""
+
+Asynchronous logging. The handlers configured with logging.config.fileConfig
+are moved behind a bounded queue, and a background thread does the actual
+file or stdout I/O, so that a slow disk or a blocked supervisor pipe
+does not stall the polling threads. If the queue is full, log records
+are dropped and counted.
+
+"""
+
+import logging
+import logging.handlers
+import queue
+import atexit
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler which never blocks: drops records when the queue is full.
+    """
+    def __init__(self, q):
+        logging.handlers.QueueHandler.__init__(self, q)
+        self.dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogQueue:
+    def __init__(self, max_queue=10000):
+        self.handlers = []
+        self.listeners = []
+        
+        # Each logger which has handlers gets a queue of its own, so
+        # that records end up in the same handlers as before.
+        loggers = [logging.getLogger()]
+        loggers.extend([l for l in logging.Logger.manager.loggerDict.values() if isinstance(l, logging.Logger)])
+        
+        for logger in loggers:
+            if not logger.handlers:
+                continue
+            
+            q = queue.Queue(max_queue)
+            listener = logging.handlers.QueueListener(q, *logger.handlers, respect_handler_level=True)
+            handler = DroppingQueueHandler(q)
+            
+            for h in list(logger.handlers):
+                logger.removeHandler(h)
+            logger.addHandler(handler)
+            
+            listener.start()
+            self.handlers.append(handler)
+            self.listeners.append(listener)
+        
+        atexit.register(self.stop)
+    
+    def dropped(self):
+        """
+        Total number of log records dropped due to a full queue
+        """
+        return sum([h.dropped for h in self.handlers])
+    
+    def queued(self):
+        """
+        Number of log records currently waiting in the queues
+        """
+        return sum([h.queue.qsize() for h in self.handlers])
+    
+    def stop(self):
+        """
+        Flush queued records and stop the background threads
+        """
+        for listener in self.listeners:
+            try:
+                listener.stop()
+            except Exception:
+                pass
+        self.listeners = []
@@ -0,0 +1,213 @@
+
+"""
+
+Internal metrics of the poller and DNS driver, served over HTTP
+in the OpenMetrics text format, so that capacity problems can be
+spotted before servers start going stale.
+
+Metrics are registered in the module-level registry, and can be
+updated from any thread.
+
+"""
+
+import threading
+import math
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def fmt_value(v):
+    if v == math.inf:
+        return '+Inf'
+    if isinstance(v, int):
+        return '%d' % v
+    return repr(float(v))
+
+def fmt_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs])
+
+class Metric:
+    def __init__(self, type, name, help, labels=(), func=None):
+        self.type = type
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # for metrics whose value is read from elsewhere when rendering
+        self.func = func
+        # label values tuple => value
+        self.values = {}
+        self.lock = threading.Lock()
+        
+        if not self.labels and not func:
+            self.values[()] = 0
+    
+    def label_key(self, labels):
+        return tuple([labels.get(k, '') for k in self.labels])
+    
+    def render_header(self):
+        return ['# TYPE %s %s' % (self.name, self.type), '# HELP %s %s' % (self.name, self.help)]
+
+class Counter(Metric):
+    def __init__(self, name, help, labels=(), func=None):
+        Metric.__init__(self, 'counter', name, help, labels, func)
+    
+    def inc(self, amount=1, **labels):
+        k = self.label_key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + amount
+    
+    def render(self):
+        l = self.render_header()
+        if self.func:
+            l.append('%s_total %s' % (self.name, fmt_value(self.func())))
+        else:
+            with self.lock:
+                for k in sorted(self.values):
+                    l.append('%s_total%s %s' % (self.name, fmt_labels(self.labels, k), fmt_value(self.values[k])))
+        return l
+
+class Gauge(Metric):
+    def __init__(self, name, help, labels=(), func=None):
+        Metric.__init__(self, 'gauge', name, help, labels, func)
+    
+    def set(self, value, **labels):
+        k = self.label_key(labels)
+        with self.lock:
+            self.values[k] = value
+    
+    def render(self):
+        l = self.render_header()
+        if self.func:
+            l.append('%s %s' % (self.name, fmt_value(self.func())))
+        else:
+            with self.lock:
+                for k in sorted(self.values):
+                    l.append('%s%s %s' % (self.name, fmt_labels(self.labels, k), fmt_value(self.values[k])))
+        return l
+
+class Histogram(Metric):
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        Metric.__init__(self, 'histogram', name, help, labels)
+        if not self.labels:
+            self.values[()] = self.empty()
+    
+    def empty(self):
+        return { 'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0 }
+    
+    def observe(self, value, **labels):
+        k = self.label_key(labels)
+        with self.lock:
+            h = self.values.get(k)
+            if h == None:
+                h = self.values[k] = self.empty()
+            for i in range(len(self.buckets)):
+                if value <= self.buckets[i]:
+                    h['counts'][i] += 1
+                    break
+            h['sum'] += value
+            h['count'] += 1
+    
+    def render(self):
+        l = self.render_header()
+        with self.lock:
+            for k in sorted(self.values):
+                h = self.values[k]
+                cum = 0
+                for i in range(len(self.buckets)):
+                    cum += h['counts'][i]
+                    l.append('%s_bucket%s %d' % (self.name, fmt_labels(self.labels, k, ('le', fmt_value(self.buckets[i]))), cum))
+                l.append('%s_sum%s %s' % (self.name, fmt_labels(self.labels, k), fmt_value(h['sum'])))
+                l.append('%s_count%s %d' % (self.name, fmt_labels(self.labels, k), h['count']))
+        return l
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+    
+    def register(self, metric):
+        """
+        Register a metric. If one with the same name exists, it is returned instead.
+        """
+        with self.lock:
+            old = self.metrics.get(metric.name)
+            if old != None:
+                return old
+            self.metrics[metric.name] = metric
+            return metric
+    
+    def render(self):
+        with self.lock:
+            metrics = [self.metrics[k] for k in sorted(self.metrics)]
+        
+        l = []
+        for m in metrics:
+            try:
+                l.extend(m.render())
+            except Exception:
+                # a broken value callback should not break the whole output
+                pass
+        l.append('# EOF')
+        
+        return '\n'.join(l) + '\n'
+
+registry = Registry()
+
+def counter(name, help, labels=(), func=None):
+    return registry.register(Counter(name, help, labels, func))
+
+def gauge(name, help, labels=(), func=None):
+    return registry.register(Gauge(name, help, labels, func))
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help, labels, buckets))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        
+        d = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(d)))
+        self.end_headers()
+        self.wfile.write(d)
+    
+    def log_message(self, format, *args):
+        pass
+
+class MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_server(log, listen):
+    """
+    Start serving metrics at http://listen/metrics, listen being "host:port"
+    """
+    host, sep, port = listen.rpartition(':')
+    host = host.strip('[]')
+    
+    try:
+        server = MetricsHTTPServer((host, int(port)), MetricsHandler)
+    except (OSError, ValueError) as e:
+        log.error("Metrics: failed to listen on %s: %r", listen, e)
+        return None
+    
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    log.info("Metrics: serving OpenMetrics on http://%s/metrics", listen)
+    
+    return server
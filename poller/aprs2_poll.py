@@ -4,6 +4,9 @@ import requests
 import json
 import re
 import socket
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from lxml import etree
 from subprocess import Popen, STDOUT, PIPE
 
@@ -11,6 +14,9 @@ from subprocess import Popen, STDOUT, PIPE
 import aprsis
 import aprs2_score
 import aprs2_redis
+import aprs2_breaker
+import aprs2_tcpinfo
+import aprs2_metrics
 
 # compile regular expressions to make them run faster
 javap3_re = {
@@ -49,29 +55,48 @@ javap3_re_outbound_line = re.compile('<TR[^>]*><TD[^>]*><A[^>]+>([^/<]+)/([^<]+)
 javap3_re_uptime = re.compile('(\\d+)(\\.\d+){0,1}([dhms])(.*)')
 javap3_re_numeric_sanitize = re.compile('[^\\d]+')
 
-re_ipv4_port = re.compile('(\\d+\\.\\d+\\.\\d+\\.\\d+):(\\d+)')
-re_ipv6_port = re.compile('([0-9a-f]+:[0-9a-f]+:[0-9a-f]+:[0-9a-f]+:[0-9a-f]+:[0-9a-f]+:[0-9a-f]+:[0-9a-f]+):(\\d+)')
+# latency of the poll stages, aggregated over all polls, for capacity monitoring
+stage_latency = aprs2_metrics.histogram('aprs2_poll_stage_seconds', 'Duration of server poll stages', ('stage',))
 
 def javap3_strfloat(s):
     # replace non-digits with empty strings
     s = javap3_re_numeric_sanitize.sub('', s)
     return float(s)
 
-def inet6_normalize(addr_s):
-    try:
-        internal = socket.inet_pton(socket.AF_INET6, addr_s)
-        return socket.inet_ntop(socket.AF_INET6, internal)
-    except socket.error:
-        return None
+class UplinkRateCache:
+    """
+    Bounded cache of previous per-uplink packet counters, for calculating
+    packet rates between polls. The least recently updated entries are
+    dropped when the cache is full.
+    """
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def update(self, key, entry):
+        """
+        Store a new entry, and return the previous one for the same key
+        """
+        with self.lock:
+            prev = self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        
+        return prev
 
 class Poll:
-    def __init__(self, log, server, red, software_type_cache, rates_cache, address_map):
+    def __init__(self, log, server, red, software_type_cache, rates_cache, config, poll_budget=None, breaker=None,
+            tcp_rtt_cache=None, ping_duration=30, ping_duration_tcp_rtt=30,
+            topology=None, uplink_rates_cache=None):
         self.log = log
         self.server = server
         self.red = red
         self.software_type_cache = software_type_cache
         self.rates_cache = rates_cache
-        self.address_map = address_map
+        # in-memory configuration snapshot (servers, address map, rotates)
+        self.config = config
         self.id = server['id']
         self.status_url = 'http://%s:14501/' % self.server['ipv4']
         self.rhead = {'User-agent': 'aprs2net-poller/2.0'}
@@ -86,6 +111,50 @@ class Poll:
         self.score = aprs2_score.Score()
         
         self.errors = []
+        
+        # End-to-end time budget for the whole poll, in seconds (None: unlimited).
+        # Every stage checks the budget before starting and limits its own
+        # timeouts to the time left.
+        self.poll_budget = poll_budget
+        self.deadline = time.monotonic() + poll_budget if poll_budget else None
+        self.budget_expired = False
+        
+        # Circuit breaker for servers which are down hard (None: disabled)
+        self.breaker = breaker
+        self.breaker_skipped = False
+        # only the connect check was done, and it failed
+        self.probe_failed = False
+        # could not connect to the server at all (read timeouts don't count)
+        self.connect_failed = False
+        
+        # Which servers gave us a kernel TCP RTT estimate on the previous poll;
+        # for those the ping test can be shortened (or skipped, if 0)
+        self.tcp_rtt_cache = tcp_rtt_cache
+        self.ping_duration = ping_duration
+        self.ping_duration_tcp_rtt = ping_duration_tcp_rtt
+        
+        # Network-wide uplink topology graph (None: disabled)
+        self.topology = topology
+        
+        # Previous uplink packet counters (None: disabled)
+        self.uplink_rates_cache = uplink_rates_cache
+        
+        # time spent in each stage of the poll, seconds
+        self.stage_t = OrderedDict()
+    
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the poll, using a monotonic clock
+        """
+        
+        t_start = time.monotonic()
+        try:
+            yield
+        finally:
+            t_dur = time.monotonic() - t_start
+            self.stage_t[name] = self.stage_t.get(name, 0) + t_dur
+            stage_latency.observe(t_dur, stage=name)
     
     def error(self, code, msg):
         """
@@ -96,6 +165,115 @@ class Poll:
         self.errors.append([code, msg])
         return False
     
+    def budget_left(self):
+        """
+        Return the number of seconds left in the polling time budget,
+        or None if the budget is unlimited
+        """
+        
+        if self.deadline == None:
+            return None
+        
+        return self.deadline - time.monotonic()
+    
+    def budget_timeout(self, timeout):
+        """
+        Limit a stage timeout so that it does not run past the polling time budget
+        """
+        
+        left = self.budget_left()
+        if left == None:
+            return timeout
+        
+        return max(0.1, min(timeout, left))
+    
+    def read_body(self, r, t_start):
+        """
+        Read a streamed HTTP response body, enforcing a total deadline of
+        http_timeout seconds from t_start, limited by the poll budget.
+        The requests timeout only limits the time between reads, so a
+        slowly trickling body could otherwise run past the budget. The
+        socket timeout is lowered to the time left before each read, so
+        that a stall between chunks does not run past the deadline either.
+        """
+        
+        deadline = t_start + self.http_timeout
+        if self.deadline != None:
+            deadline = min(deadline, self.deadline)
+        chunks = []
+        try:
+            it = r.iter_content(chunk_size=16384)
+            while True:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise Exception("Response body not received within %.1f s" % (deadline - t_start))
+                self.set_read_timeout(r, left)
+                chunk = next(it, None)
+                if chunk == None:
+                    break
+                chunks.append(chunk)
+        finally:
+            r.close()
+        
+        return b''.join(chunks)
+    
+    def set_read_timeout(self, r, timeout):
+        """
+        Set the socket timeout of a streamed HTTP response, while its
+        connection is still open
+        """
+        
+        try:
+            sock = r.raw.connection.sock
+        except AttributeError:
+            return
+        
+        if sock != None:
+            sock.settimeout(timeout)
+    
+    def http_fail(self, r, e, path):
+        """
+        Record a failed HTTP status page request. Only a failure to connect
+        (no response at all) counts against the circuit breaker: a read
+        timeout or a slow body means the server is up, but slow.
+        """
+        
+        if r == None and isinstance(e, requests.exceptions.ConnectionError):
+            self.connect_failed = True
+        
+        return self.error('web-http-fail', "%s: HTTP status page 14501 %s: Connection error: %s" % (self.id, path, e))
+    
+    def budget_exceeded(self, stage):
+        """
+        Check if the polling time budget has run out before a stage.
+        A timeout-budget error is recorded the first time it happens.
+        """
+        
+        left = self.budget_left()
+        if left == None or left > 0:
+            return False
+        
+        if not self.budget_expired:
+            self.budget_expired = True
+            self.error('timeout-budget', 'Poll time budget of %.0f s exceeded, skipping %s and later stages' % (self.poll_budget, stage))
+        
+        return True
+    
+    def record_tcp_info(self, probe, ti):
+        """
+        Store kernel TCP RTT estimate for a probe connection
+        """
+        
+        if ti == None:
+            return
+        
+        self.log.debug("%s: TCP RTT %s: %.1f ms, rttvar %.1f ms, %d retransmits", self.id, probe, ti['rtt'], ti['rttvar'], ti['total_retrans'])
+        
+        if 'tcp_rtt' not in self.properties:
+            self.properties['tcp_rtt'] = {}
+        
+        self.properties['tcp_rtt'][probe] = ti
+    
     def map_addr_id(self, addr):
         """
         Map server address to a server ID, if possible (for figuring out uplink)
@@ -103,16 +281,7 @@ class Poll:
         
         self.log.debug("mapping address to server: %r", addr)
         
-        v4 = re_ipv4_port.match(addr)
-        if v4 != None:
-            return self.address_map.get(v4.group(1))
-        
-        v6 = re_ipv6_port.match(addr)
-        if v6 != None:
-            #self.log.debug("  v6 addr: %r", inet6_normalize(v6.group(1)))
-            return self.address_map.get(inet6_normalize(v6.group(1)))
-        
-        return "unknown"
+        return self.config.address_index.lookup(addr)
     
     def poll_main(self):
         """
@@ -121,8 +290,26 @@ class Poll:
         self.log.info("polling %s", self.id)
         self.log.debug("config: %r", self.server)
         
+        # Servers which have been unreachable for a while only get a cheap
+        # connect check every now and then, until they respond again.
+        if self.breaker:
+            state = self.breaker.check(self.id)
+            if state == aprs2_breaker.SKIP:
+                self.log.info("%s: Circuit breaker open, not polling", self.id)
+                self.errors = self.breaker.last_errors(self.id)
+                self.breaker_skipped = True
+                return False
+            
+            if state == aprs2_breaker.PROBE:
+                self.log.info("%s: Circuit breaker open, trying a connect check", self.id)
+                with self.stage('connect-check'):
+                    if not self.connect_check():
+                        self.probe_failed = True
+                        return False
+        
         # perform ICMP ECHO round-trip-time + packet loss test
-        self.ping()
+        with self.stage('ping'):
+            self.ping()
         
         # check if we know its software type already
         try_first = self.software_type_cache.get(self.id)
@@ -138,6 +325,9 @@ class Poll:
         for t in self.try_order:
             r = False
             
+            if self.budget_exceeded('status'):
+                return False
+            
             if t == 'aprsc':
                 r = self.poll_aprsc()
             if t == 'javap4':
@@ -159,6 +349,7 @@ class Poll:
                 return False
                 
             self.calculate_rates()
+            self.calculate_uplink_rates()
             
             self.log.debug("%s: Server users %d/%d (%.1f %% total, %.1f %% worst-case)",
                 self.id, self.properties['clients'], self.properties['clients_max'], self.properties['user_load'], self.properties['worst_load'])
@@ -179,14 +370,36 @@ class Poll:
         if not self.service_tests():
             return False
         
-        if not self.check_uplink():
+        if self.budget_exceeded('uplink'):
             return False
         
+        with self.stage('uplink'):
+            if not self.check_uplink():
+                return False
+        
         return True
     
     def poll(self):
         success = self.poll_main()
         
+        if self.topology and not self.breaker_skipped:
+            with self.stage('topology'):
+                flags = self.topology.update(self.id, self.properties.get('uplinks', []), success == True, self.config)
+            for code, msg in flags:
+                self.log.info("%s: Uplink topology [%s]: %s", self.id, code, msg)
+            if flags:
+                self.properties['uplink_flags'] = flags
+        
+        if self.tcp_rtt_cache != None and not self.breaker_skipped:
+            self.tcp_rtt_cache[self.id] = 'tcp_rtt' in self.properties
+        
+        if self.breaker and not self.breaker_skipped:
+            self.breaker.record(self.id, self.connect_failed, self.errors)
+        
+        if self.stage_t:
+            self.properties['stage_t'] = dict([(k, round(v, 3)) for k, v in self.stage_t.items()])
+            self.log.info("%s: Stage timings: %s", self.id, ', '.join(['%s %.3f s' % (k, v) for k, v in self.stage_t.items()]))
+        
         if success != True:
             self.score.score_add('server-fail', 1000, '1000')
             
@@ -196,6 +409,21 @@ class Poll:
         
         return success
     
+    def connect_check(self):
+        """
+        Cheap liveness check for servers which are down hard:
+        just try to open a TCP connection to the HTTP status port.
+        """
+        
+        try:
+            s = socket.create_connection((self.server['ipv4'], 14501), timeout=self.budget_timeout(5))
+            s.close()
+        except socket.error as e:
+            self.connect_failed = True
+            return self.error('web-http-fail', "%s: HTTP status port 14501: Connection error: %s" % (self.id, e))
+        
+        return True
+    
     def check_properties(self):
         """
         Validate properties received from HTTP status page
@@ -242,6 +470,38 @@ class Poll:
             prev[i] = self.properties[i]
         self.rates_cache[self.id] = prev
     
+    def calculate_uplink_rates(self):
+        """
+        Calculate received packets/sec rates for each uplink
+        """
+        
+        if self.uplink_rates_cache == None:
+            return
+        
+        now = time.time()
+        
+        for upl in self.properties.get('uplinks', []):
+            rx_packets = upl.get('rx_packets')
+            up = upl.get('up')
+            if rx_packets == None or up == None:
+                continue
+            
+            # The connection time is used to detect reconnects: a new
+            # connection has new counters. Allow for some clock jitter.
+            connect_t = now - up
+            key = '%s %s' % (self.id, upl.get('id') or upl.get('addr_rem'))
+            prev = self.uplink_rates_cache.update(key, { 't': now, 'connect_t': connect_t, 'rx_packets': rx_packets })
+            
+            if prev == None or abs(prev['connect_t'] - connect_t) > 60:
+                continue
+            
+            dur_t = now - prev['t']
+            if dur_t <= 0 or rx_packets < prev['rx_packets']:
+                continue
+            
+            upl['rx_rate'] = (rx_packets - prev['rx_packets']) / dur_t
+            self.log.debug("%s: Uplink %s: %.1f packets/s received", self.id, upl.get('id'), upl['rx_rate'])
+    
     def javap3_decode_uptime(self, s):
         """
         Decode javaprssrvr3 uptime string
@@ -279,11 +539,15 @@ class Poll:
     
         # get front page, figure out which server type it is
         t_start = time.time()
+        r = None
         try:
-            r = requests.get(self.status_url, headers=self.rhead, timeout=self.http_timeout)
-            d = r.text
+            with self.stage('detect'):
+                t_req = time.monotonic()
+                r = requests.get(self.status_url, headers=self.rhead, timeout=self.budget_timeout(self.http_timeout), stream=True)
+                self.record_tcp_info('http', aprs2_tcpinfo.response_tcp_info(r))
+                d = self.read_body(r, t_req).decode(r.encoding or 'iso-8859-1', errors='replace')
         except Exception as e:
-            return self.error('web-http-fail', "%s: HTTP status page 14501 /: Connection error: %s" % (self.id, e))
+            return self.http_fail(r, e, '/')
             
         t_end = time.time()
         t_dur = t_end - t_start
@@ -301,7 +565,8 @@ class Poll:
         
         self.score.http_status_t = t_dur
         
-        return self.parse_javaprssrvr3(d)
+        with self.stage('parse'):
+            return self.parse_javaprssrvr3(d)
     
     def parse_javaprssrvr3(self, d):
         """
@@ -381,11 +646,15 @@ class Poll:
         """
         
         t_start = time.time()
+        r = None
         try:
-            r = requests.get('%s%s' % (self.status_url, 'detail.xml'), headers=self.rhead, timeout=self.http_timeout)
-            d = r.content
+            with self.stage('detect'):
+                t_req = time.monotonic()
+                r = requests.get('%s%s' % (self.status_url, 'detail.xml'), headers=self.rhead, timeout=self.budget_timeout(self.http_timeout), stream=True)
+                self.record_tcp_info('http', aprs2_tcpinfo.response_tcp_info(r))
+                d = self.read_body(r, t_req)
         except Exception as e:
-            return self.error('web-http-fail', "%s: HTTP status page 14501 /detail.xml: Connection error: %s" % (self.id, e))
+            return self.http_fail(r, e, '/detail.xml')
             
         if r.status_code == 404:
             self.log.info("%s: detail.xml 404 Not Found - not javAPRSSrvr 4", self.id)
@@ -400,7 +669,8 @@ class Poll:
         t_dur = t_end - t_start
         self.score.http_status_t = t_dur
         
-        return self.parse_javaprssrvr4(d)
+        with self.stage('parse'):
+            return self.parse_javaprssrvr4(d)
     
     def parse_javaprssrvr4(self, d):
         """
@@ -577,11 +847,15 @@ class Poll:
         """
         
         t_start = time.time()
+        r = None
         try:
-            r = requests.get('%s%s' % (self.status_url, 'status.json'), headers=self.rhead, timeout=self.http_timeout)
-            d = r.content
+            with self.stage('detect'):
+                t_req = time.monotonic()
+                r = requests.get('%s%s' % (self.status_url, 'status.json'), headers=self.rhead, timeout=self.budget_timeout(self.http_timeout), stream=True)
+                self.record_tcp_info('http', aprs2_tcpinfo.response_tcp_info(r))
+                d = self.read_body(r, t_req)
         except Exception as e:
-            return self.error('web-http-fail', "%s: HTTP status page 14501 /status.json: Connection error: %s" % (self.id, e))
+            return self.http_fail(r, e, '/status.json')
             
         self.log.debug("%s: HTTP GET /status.json returned: %r", self.id, r.status_code)
         
@@ -595,13 +869,14 @@ class Poll:
         t_dur = t_end - t_start
         self.score.http_status_t = t_dur
         
-        try:
-            j = json.loads(d)
-        except Exception as e:
-            self.log.info("%s: JSON parsing failed: %r", self.id, e)
-            return self.error('web-json-fail', 'aprsc status.json JSON parsing failed')
-        
-        return self.parse_aprsc(j)
+        with self.stage('parse'):
+            try:
+                j = json.loads(d)
+            except Exception as e:
+                self.log.info("%s: JSON parsing failed: %r", self.id, e)
+                return self.error('web-json-fail', 'aprsc status.json JSON parsing failed')
+            
+            return self.parse_aprsc(j)
         
     def parse_aprsc(self, j):
         """
@@ -732,6 +1007,9 @@ class Poll:
         # For some reason python-requests does not accept IPv6 literal addresses in an URL.
         # So, let's go IPv4 only for now.
         for ac in ('ipv4',):
+            if self.budget_exceeded('http-submit'):
+                return
+            
             if ac in self.server:
                 if ac == 'ipv4':
                     url = 'http://%s:8080/' % self.server[ac]
@@ -740,7 +1018,9 @@ class Poll:
                     
                 t_start = time.time()
                 try:
-                    r = requests.get(url, headers=self.rhead, timeout=self.http_timeout)
+                    # only the headers are needed, the body is not read
+                    r = requests.get(url, headers=self.rhead, timeout=self.budget_timeout(self.http_timeout), stream=True)
+                    r.close()
                 except Exception as e:
                     self.log.info("%s: HTTP submit 8080: Connection error: %s", self.id, e)
                     continue
@@ -804,7 +1084,7 @@ class Poll:
         upl = ups[0]
         
         uplink_id = upl.get('id')
-        uplink_server = self.red.getServer(uplink_id) if uplink_id else None
+        uplink_server = self.config.getServer(uplink_id) if uplink_id else None
         self.log.debug("uplink is: %r", uplink_server)
         if uplink_server == None:
             return self.error('uplinks-odd', 'Connected to unregistered upstream server')
@@ -825,7 +1105,11 @@ class Poll:
         Perform APRS-IS service tests
         """
         
-        self.poll_http_submit()
+        with self.stage('http-submit'):
+            self.poll_http_submit()
+        
+        if self.budget_exceeded('aprs-is'):
+            return False
         
         t = aprsis.TCPPoll(self.log)
         ok = True
@@ -837,21 +1121,44 @@ class Poll:
         
         for ac, prefix in (('ipv4', 'IS4'), ('ipv6', 'IS6')):
             if self.server.get(ac) != None:
+                if self.budget_exceeded('aprs-is ' + ac):
+                    return False
+                
+                t.sock_timeout = self.budget_timeout(5)
                 t_start = time.time()
-                [code, msg] = t.poll(self.server[ac], port, self.id, prefix)
+                with self.stage('aprs-is'):
+                    [code, msg] = t.poll(self.server[ac], port, self.id, prefix)
                 t_dur = time.time() - t_start
                 
                 if code != 'ok':
                     self.error(code, "%s TCP %d: %s" % (ac, port, msg))
                     ok = False
                 else:
+                    self.record_tcp_info('is-' + ac, t.tcp_info)
                     ok_count += 1
                     self.score.poll_t_14580[ac] = t_dur
         
         return ok and ok_count > 0
 
     def ping(self):
-        lines = Popen(["ping", "-i", "1", "-w", "30", "-n", self.server['ipv4']],
+        # If the server gave us a TCP RTT estimate last time, we don't need
+        # to spend so much time on pinging it.
+        duration = self.ping_duration
+        if self.tcp_rtt_cache and self.tcp_rtt_cache.get(self.id):
+            duration = self.ping_duration_tcp_rtt
+            if duration < 1:
+                self.log.info("%s: TCP RTT available, skipping ping", self.id)
+                return False
+        
+        # leave some of the budget for the actual service tests
+        left = self.budget_left()
+        if left != None:
+            duration = min(duration, int(left / 2))
+            if duration < 1:
+                self.log.info("%s: Not enough poll time budget left for ping", self.id)
+                return False
+        
+        lines = Popen(["ping", "-i", "1", "-w", str(duration), "-n", self.server['ipv4']],
             stdout=PIPE, stderr=STDOUT).communicate()[0].decode('UTF-8').split("\n")
         
         if len(lines) < 3:
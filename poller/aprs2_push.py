@@ -0,0 +1,271 @@
+
+"""
+
+Push-mode federation: pollers push the results of their polls to the
+DNS driver as they come in, in batches, over a keep-alive HTTP
+connection, instead of waiting for the DNS driver to fetch them.
+
+The batches are authenticated with a HMAC-SHA256 of the request body,
+using a key shared by the poller and the DNS driver. The signature is
+checked before the body is parsed. The body carries a timestamp and a
+sequence number, which must increase for each batch from a poller, so
+that batches cannot be replayed.
+
+"""
+
+import threading
+import time
+import json
+import hmac
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+SIGNATURE_HEADER = 'X-Aprs2-Signature'
+SITE_HEADER = 'X-Aprs2-Site'
+
+# batches older (or newer) than this are rejected, seconds
+max_clock_skew = 300
+# max size of a pushed batch, bytes
+max_body_len = 16*1024*1024
+
+def sign(key, body):
+    return hmac.new(key.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+def trim_config(server):
+    """
+    Drop server config elements which the DNS driver does not need,
+    the same way the web service does for /api/full
+    """
+    conf = dict(server)
+    for k in ('deleted', 'host', 'domain'):
+        conf.pop(k, None)
+    if not conf.get('out_of_service'):
+        conf.pop('out_of_service', None)
+    
+    return conf
+
+class StatusPusher:
+    """
+    Push poll results to the DNS driver. Results are coalesced per server
+    while waiting to be sent, so that a DNS driver outage only keeps the
+    latest status of each server around, and that's what gets sent when
+    it comes back.
+    """
+    def __init__(self, log, url, site, key, batch_size=100, flush_interval=1.0, timeout=10.0):
+        self.log = log
+        self.url = url
+        self.site = site
+        self.key = key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        
+        # retry backoff after failures, seconds
+        self.backoff_min = 5
+        self.backoff_max = 120
+        self.backoff = self.backoff_min
+        
+        # server id => {'config': ..., 'status': ...}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        
+        self.pushed = 0
+        self.failures = 0
+        
+        # sequence number of the latest batch; based on time, so that it
+        # keeps increasing over poller restarts
+        self.seq = 0
+        
+        self.session = requests.Session()
+        self.session.headers.update({'User-agent': 'aprs2net-poller/2.0', 'Content-Type': 'application/json'})
+        
+        t = threading.Thread(target=self.__run)
+        t.daemon = True
+        t.start()
+    
+    def push(self, server, status):
+        """
+        Queue the status of a server for pushing. Never blocks.
+        """
+        with self.lock:
+            self.pending[server['id']] = { 'config': trim_config(server), 'status': status }
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.set()
+    
+    def __run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            
+            while True:
+                with self.lock:
+                    if not self.pending:
+                        break
+                    ids = list(self.pending.keys())[0:self.batch_size]
+                    batch = [self.pending.pop(id) for id in ids]
+                
+                if self.send(batch):
+                    self.backoff = self.backoff_min
+                    continue
+                
+                # put back the ones which have not been replaced by newer ones
+                with self.lock:
+                    for entry in batch:
+                        self.pending.setdefault(entry['config']['id'], entry)
+                
+                self.log.info("Status push: retrying in %d s", self.backoff)
+                time.sleep(self.backoff)
+                self.backoff = min(self.backoff * 2, self.backoff_max)
+    
+    def send(self, batch):
+        """
+        Send a batch of server statuses
+        """
+        self.seq = max(self.seq + 1, int(time.time() * 1000000))
+        body = json.dumps({ 'site': self.site, 't': time.time(), 'seq': self.seq, 'servers': batch }).encode('utf-8')
+        
+        try:
+            r = self.session.post(self.url, data=body, timeout=self.timeout,
+                headers={SITE_HEADER: self.site, SIGNATURE_HEADER: sign(self.key, body)})
+        except Exception as e:
+            self.failures += 1
+            self.log.error("Status push to %s failed: %r", self.url, e)
+            return False
+        
+        if r.status_code != 200:
+            self.failures += 1
+            self.log.error("Status push to %s failed: HTTP status %d", self.url, r.status_code)
+            return False
+        
+        self.pushed += len(batch)
+        self.log.debug("Status push: sent %d servers, %d bytes", len(batch), len(body))
+        return True
+
+class PushHandler(BaseHTTPRequestHandler):
+    # keep-alive, so that the pushers can send batch after batch over the
+    # same connection; all responses have a Content-Length
+    protocol_version = 'HTTP/1.1'
+    
+    def do_POST(self):
+        receiver = self.server.receiver
+        
+        if self.path.split('?')[0] != '/api/push':
+            self.send_error(404)
+            return
+        
+        try:
+            body_len = int(self.headers.get('Content-Length', 0))
+            if body_len > max_body_len:
+                self.send_error(413)
+                return
+            body = self.rfile.read(body_len)
+        except (ValueError, OSError):
+            self.send_error(400)
+            return
+        
+        code = receiver.receive(body, self.headers.get(SITE_HEADER, ''), self.headers.get(SIGNATURE_HEADER, ''))
+        
+        d = json.dumps({ 'result': 'ok' if code == 200 else 'fail' }).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(d)))
+        self.end_headers()
+        self.wfile.write(d)
+    
+    def log_message(self, format, *args):
+        pass
+
+class PushHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class PushReceiver:
+    """
+    Receive pushed poll results in the DNS driver. handler(site, servers)
+    is called for each authenticated batch, from the HTTP server's threads.
+    """
+    def __init__(self, log, keys, handler):
+        self.log = log
+        # site => shared key
+        self.keys = keys
+        self.handler = handler
+        self.server = None
+        
+        # site => sequence number of the latest accepted batch
+        self.seq = {}
+        self.seq_lock = threading.Lock()
+        # Sequence numbers are microsecond timestamps of the pushers. Batches
+        # signed before we started are not accepted, so that batches captured
+        # before a restart cannot be replayed after it.
+        self.seq_watermark = int(time.time() * 1000000)
+    
+    def receive(self, body, site, signature):
+        """
+        Check and process a pushed batch, returns a HTTP status code
+        """
+        # authenticate before parsing anything
+        key = self.keys.get(site)
+        if key == None or not hmac.compare_digest(sign(key, body), signature):
+            self.log.error("Status push from %r: authentication failed", site)
+            return 403
+        
+        try:
+            j = json.loads(body)
+            t = float(j['t'])
+            seq = int(j['seq'])
+            servers = j['servers']
+        except (ValueError, KeyError, TypeError):
+            self.log.error("Status push from %r: invalid request", site)
+            return 400
+        
+        if j.get('site') != site:
+            self.log.error("Status push from %r: site %r in body does not match", site, j.get('site'))
+            return 403
+        
+        if abs(time.time() - t) > max_clock_skew:
+            self.log.error("Status push from %r: timestamp off by %.0f s, rejected", site, time.time() - t)
+            return 403
+        
+        with self.seq_lock:
+            last = self.seq.get(site, self.seq_watermark)
+            if seq <= last:
+                self.log.error("Status push from %r: sequence %d not above %d, replay rejected", site, seq, last)
+                return 403
+            self.seq[site] = seq
+        
+        if not type(servers) is list:
+            self.log.error("Status push from %r: servers is not a list", site)
+            return 400
+        
+        try:
+            self.handler(site, servers)
+        except Exception:
+            self.log.exception("Status push from %r: processing failed", site)
+            return 500
+        
+        return 200
+    
+    def start(self, listen):
+        """
+        Start listening for pushes at http://listen/api/push, listen being "host:port"
+        """
+        host, sep, port = listen.rpartition(':')
+        host = host.strip('[]')
+        
+        try:
+            self.server = PushHTTPServer((host, int(port)), PushHandler)
+        except (OSError, ValueError) as e:
+            self.log.error("Status push: failed to listen on %s: %r", listen, e)
+            return False
+        
+        self.server.receiver = self
+        
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.log.info("Status push: listening on http://%s/api/push", listen)
+        
+        return True
@@ -8,11 +8,14 @@ aprs2.net server status poller
 import redis
 import time
 import json
+import zlib
+import os
 
 kServer = 'aprs2.server'
 kAddressMap = 'aprs2.addrmap'
 kServerStatus = 'aprs2.serverstat'
 kServerLog = 'aprs2.serverlog'
+kServerLogHistory = 'aprs2.serverloghist.'
 kPollQueue = 'aprs2.pollq'
 kScore = 'aprs2.score'
 kAvail = 'aprs2.avail'
@@ -22,6 +25,29 @@ kWebConfig = 'aprs2.webconfig'
 kRotate = 'aprs2.rotate'
 kRotateStatus = 'aprs2.rotateStatus'
 kRotateStats = 'aprs2.rotateStats'
+kConfigVersion = 'aprs2.configVersion'
+kChannelConfig = 'aprs2.chConfig'
+kUplinkGraph = 'aprs2.uplinkgraph'
+kStatusSeq = 'aprs2.statusseq'
+kStatusChanges = 'aprs2.statuschanges'
+kStatusEpoch = 'aprs2.statusepoch'
+kDnsCache = 'aprs2.dnscache'
+
+# Store a server status (or delete it, if no status is given) and record
+# the change in the change feed, atomically. The change feed has the
+# latest change sequence number of each server. The epoch changes if the
+# database is wiped, so that readers know they need a full resync.
+lua_set_status = """
+redis.call('SETNX', KEYS[4], ARGV[3])
+local seq = redis.call('INCR', KEYS[1])
+if ARGV[2] == '' then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+redis.call('ZADD', KEYS[3], seq, ARGV[1])
+return seq
+"""
 
 def lsum(list):
     d = 0
@@ -36,6 +62,20 @@ class APRS2Redis:
         aprs2.net status storage in Redis
         """
         self.red = redis.Redis(host=host, port=port, db=db, charset="utf-8", decode_responses=True)
+        # for binary (compressed) values
+        self.red_bin = redis.Redis(host=host, port=port, db=db)
+        
+        self.set_status_script = self.red.register_script(lua_set_status)
+        
+        # XTRIM MINID needs Redis 6.2 and redis-py 4; without them the log
+        # history is only capped by length
+        self.xtrim_minid = True
+    
+    def ping(self):
+        """
+        Check that the database is responding
+        """
+        return self.red.ping()
     
     def setWebConfig(self, conf):
         """
@@ -59,6 +99,54 @@ class APRS2Redis:
         
         return json.loads(d)
 
+    def bumpConfigVersion(self):
+        """
+        Increment the server configuration version, and tell the
+        listeners that there's a new configuration available
+        """
+        version = self.red.incr(kConfigVersion)
+        self.red.publish(kChannelConfig, version)
+        return version
+    
+    def getConfigVersion(self):
+        """
+        Get the current server configuration version
+        """
+        d = self.red.get(kConfigVersion)
+        if d == None:
+            return d
+        
+        return int(d)
+    
+    def subscribeConfig(self):
+        """
+        Subscribe to configuration version change messages
+        """
+        pubsub = self.red.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(kChannelConfig)
+        return pubsub
+    
+    def getConfigSet(self):
+        """
+        Get configuration version, all server configurations, the address map
+        and all rotate configurations, in a single atomic transaction
+        """
+        p = self.red.pipeline(transaction=True)
+        p.get(kConfigVersion)
+        p.hgetall(kServer)
+        p.get(kAddressMap)
+        p.hgetall(kRotate)
+        version, servers, addr_map, rotates = p.execute()
+        
+        if version != None:
+            version = int(version)
+        
+        servers = dict([(k, json.loads(v)) for k, v in (servers or {}).items()])
+        rotates = dict([(k, json.loads(v)) for k, v in (rotates or {}).items()])
+        addr_map = json.loads(addr_map) if addr_map != None else {}
+        
+        return (version, servers, addr_map, rotates)
+    
     def sendServerStatusMessage(self, msg):
         self.red.publish(kChannelStatus, json.dumps(msg))
     
@@ -67,14 +155,19 @@ class APRS2Redis:
     
     def setServerStatus(self, id, status):
         """
-        Store server status
+        Store server status, and record the change in the change feed
         """
-        return self.red.hset(kServerStatus, id, json.dumps(status))
+        return self.set_status_script(keys=[kStatusSeq, kServerStatus, kStatusChanges, kStatusEpoch],
+            args=[id, json.dumps(status), os.urandom(8).hex()])
         
     def delServer(self, id):
         self.red.hdel(kServer, id)
-        self.red.hdel(kServerStatus, id)
+        # leaves a tombstone in the change feed
+        self.set_status_script(keys=[kStatusSeq, kServerStatus, kStatusChanges, kStatusEpoch],
+            args=[id, '', os.urandom(8).hex()])
         self.red.hdel(kServerLog, id)
+        self.red.delete(kServerLogHistory + id)
+        self.red.hdel(kUplinkGraph, id)
     
     def getServerIds(self):
         return self.red.hkeys(kServer)
@@ -128,6 +221,83 @@ class APRS2Redis:
         """
         return self.red.hset(kServerLog, id, json.dumps(logEntry))
         
+    def setUplinkEdges(self, id, edges):
+        """
+        Store the uplink edges of a server: [[hub id, hub address, timestamp], ...]
+        """
+        if not edges:
+            return self.red.hdel(kUplinkGraph, id)
+        
+        return self.red.hset(kUplinkGraph, id, json.dumps(edges, separators=(',', ':')))
+    
+    def setUplinkEdgesMulti(self, edges):
+        """
+        Store the uplink edges of a set of servers in a single pipeline:
+        { id: edges, ... }, an empty list of edges deletes the server's entry
+        """
+        if not edges:
+            return
+        
+        p = self.red.pipeline(transaction=False)
+        for id, e in edges.items():
+            if e:
+                p.hset(kUplinkGraph, id, json.dumps(e, separators=(',', ':')))
+            else:
+                p.hdel(kUplinkGraph, id)
+        p.execute()
+    
+    def getUplinkEdges(self):
+        """
+        Get the uplink edges of all servers
+        """
+        
+        d = self.red.hgetall(kUplinkGraph)
+        if d == None:
+            return {}
+        
+        o = {}
+        for k in d:
+            o[k] = json.loads(d[k])
+        
+        return o
+    
+    def appendServerLogHistory(self, id, logEntry, maxlen, max_age):
+        """
+        Append a poll log to the capped, compressed log history stream of
+        a server. Keeps at most maxlen entries, and none older than max_age
+        seconds (approximately). Returns the uncompressed and compressed sizes.
+        Entry IDs are assigned by Redis, which keeps them increasing even if
+        our clock steps backwards; the poll time is stored in the entry.
+        """
+        d = json.dumps(logEntry).encode('utf-8')
+        z = zlib.compress(d)
+        key = kServerLogHistory + id
+        
+        self.red_bin.xadd(key, {'t': '%d' % logEntry['t'], 'z': z}, maxlen=maxlen, approximate=True)
+        if max_age and self.xtrim_minid:
+            try:
+                self.red_bin.xtrim(key, minid=int((time.time() - max_age) * 1000), approximate=True)
+            except (TypeError, redis.ResponseError):
+                self.xtrim_minid = False
+        
+        return (len(d), len(z))
+    
+    def getServerLogHistory(self, id, t_start=None, t_end=None, count=None):
+        """
+        Get the poll logs of a server from a time range (unix timestamps).
+        The range is matched against the time the entries were stored,
+        which is just after the poll.
+        """
+        
+        start = '%d' % (t_start * 1000) if t_start != None else '-'
+        end = '%d' % (t_end * 1000) if t_end != None else '+'
+        
+        o = []
+        for entry_id, fields in self.red_bin.xrange(kServerLogHistory + id, start, end, count):
+            o.append(json.loads(zlib.decompress(fields[b'z']).decode('utf-8')))
+        
+        return o
+    
     def setPollQ(self, id, pollt):
         """
         Set the next poll time for a server ID
@@ -159,6 +329,21 @@ class APRS2Redis:
         """
         return self.red.zrangebyscore(kPollQueue, 0, time.time(), 0, max)
     
+    def getPollQueueStats(self, now=None):
+        """
+        Get the number of servers due for polling, and the scheduled
+        time of the most overdue one (None if none are due)
+        """
+        if now == None:
+            now = time.time()
+        
+        p = self.red.pipeline(transaction=False)
+        p.zcount(kPollQueue, 0, now)
+        p.zrangebyscore(kPollQueue, 0, now, 0, 1, withscores=True)
+        due, oldest = p.execute()
+        
+        return due, oldest[0][1] if oldest else None
+    
     def setScore(self, id, score):
         """
         Set the score for a server ID
@@ -204,54 +389,138 @@ class APRS2Redis:
         """
         return self.red.hset(kRotateStats, domain, json.dumps(stats))
     
+    def storeRotateStatsMulti(self, stats):
+        """
+        Store statistics for a set of rotates: { domain: stats, ... }
+        """
+        if not stats:
+            return
+        
+        return self.red.hset(kRotateStats, mapping=dict([(k, json.dumps(v)) for k, v in stats.items()]))
+    
+    def getDnsCache(self):
+        """
+        Get the DNS state last pushed for each name: { fqdn: cache_key, ... }
+        """
+        
+        d = self.red.hgetall(kDnsCache)
+        if d == None:
+            return {}
+        
+        return d
+    
+    def setDnsCache(self, entries):
+        """
+        Store the DNS state pushed for a set of names: { fqdn: cache_key, ... }
+        """
+        if not entries:
+            return
+        
+        return self.red.hset(kDnsCache, mapping=entries)
+    
+    def delDnsCache(self, fqdns):
+        """
+        Forget the DNS state of a set of names
+        """
+        if not fqdns:
+            return
+        
+        return self.red.hdel(kDnsCache, *fqdns)
+    
+    def getServerStatuses(self):
+        """
+        Get the status of all servers
+        """
+        
+        d = self.red.hgetall(kServerStatus)
+        if d == None:
+            return {}
+        
+        o = {}
+        for k in d:
+            o[k] = json.loads(d[k])
+        
+        return o
+    
+    def setServerStatuses(self, statuses):
+        """
+        Store the status of a set of servers: { id: status, ... },
+        in a single pipeline
+        """
+        
+        p = self.red.pipeline(transaction=False)
+        for id, status in statuses.items():
+            self.set_status_script(keys=[kStatusSeq, kServerStatus, kStatusChanges, kStatusEpoch],
+                args=[id, json.dumps(status), os.urandom(8).hex()], client=p)
+        p.execute()
+    
     def updateAvail(self, id, seconds, isUp):
         """
         Update the availability status of a server (N seconds, up or down).
         Returns current availability statistics, too.
         """
         
+        return self.updateAvailMulti([(id, seconds, isUp)])[id]
+    
+    def updateAvailMulti(self, updates):
+        """
+        Update the availability status of a set of servers, in a single
+        pipeline: [(id, seconds, isUp), ...].
+        Returns current availability statistics: { id: (avail_3, avail_30), ... }
+        """
+        
         # which day is it?
         now = int(time.time())
         now_day = now - (now % 86400)
         
-        # update stats
-        if isUp:
-            hkey = '%s.%d.up' % (id, now_day)
-        else:
-            hkey = '%s.%d.down' % (id, now_day)
-            
-        self.red.hincrby(kAvail, hkey, seconds)
-        #print "availability: %s for %d seconds" % (hkey, seconds)
-        
-        # calculate 30-day availability
-        upkeys = ['%s.%d.up' % (id, now_day - i*86400) for i in range(0, 30)]
-        #print "upkeys: %r" % upkeys
-        upvals = self.red.hmget(kAvail, upkeys)
-        
-        downkeys = ['%s.%d.down' % (id, now_day - i*86400) for i in range(0, 30)]
-        #print "downkeys: %r" % downkeys
-        downvals = self.red.hmget(kAvail, downkeys)
-        
-        uptime_30 = lsum(upvals)
-        downtime_30 = lsum(downvals)
-        avail_30 = float(uptime_30) / (uptime_30 + downtime_30) * 100.0
+        p = self.red.pipeline(transaction=False)
         
-        # For 3-day availability, we take today, 2 days before, and a fraction
-        # of the 3rd day, fraction depending on how far into 'today' we are.
-        # This will soften the fluctuation at midnight UTC, when a full 24 hours of
-        # availability was removed from the equation.
-        first_day_fraction =  (1.0 - (now % 86400 / 86400.0))
-        uptime_3 = lsum(upvals[0:3]) + lsum(upvals[3:4]) * first_day_fraction
-        downtime_3 = lsum(downvals[0:3]) + lsum(downvals[3:4]) * first_day_fraction
-        avail_3 = float(uptime_3) / (uptime_3 + downtime_3) * 100.0
+        for id, seconds, isUp in updates:
+            # update stats
+            if isUp:
+                hkey = '%s.%d.up' % (id, now_day)
+            else:
+                hkey = '%s.%d.down' % (id, now_day)
+                
+            p.hincrby(kAvail, hkey, seconds)
+            #print "availability: %s for %d seconds" % (hkey, seconds)
+            
+            # calculate 30-day availability
+            upkeys = ['%s.%d.up' % (id, now_day - i*86400) for i in range(0, 30)]
+            p.hmget(kAvail, upkeys)
+            
+            downkeys = ['%s.%d.down' % (id, now_day - i*86400) for i in range(0, 30)]
+            p.hmget(kAvail, downkeys)
+            
+            # expire old keys
+            delkeys = ['%s.%d.up' % (id, now_day - i*86400) for i in range(31, 38)]
+            delkeys.extend(['%s.%d.down' % (id, now_day - i*86400) for i in range(31, 38)])
+            p.hdel(kAvail, *delkeys)
         
-        #print "uptime %d seconds, downtime %d seconds - availability %.1f %%" \
-        #    % (uptime_30, downtime_30, avail_30)
+        res = p.execute()
         
-        # expire old keys
-        delkeys = ['%s.%d.up' % (id, now_day - i*86400) for i in range(31, 38)]
-        delkeys.extend(['%s.%d.down' % (id, now_day - i*86400) for i in range(31, 38)])
-        self.red.hdel(kAvail, *delkeys)
+        o = {}
+        for n in range(len(updates)):
+            id = updates[n][0]
+            upvals = res[n*4 + 1]
+            downvals = res[n*4 + 2]
+            
+            uptime_30 = lsum(upvals)
+            downtime_30 = lsum(downvals)
+            avail_30 = float(uptime_30) / (uptime_30 + downtime_30) * 100.0
+            
+            # For 3-day availability, we take today, 2 days before, and a fraction
+            # of the 3rd day, fraction depending on how far into 'today' we are.
+            # This will soften the fluctuation at midnight UTC, when a full 24 hours of
+            # availability was removed from the equation.
+            first_day_fraction =  (1.0 - (now % 86400 / 86400.0))
+            uptime_3 = lsum(upvals[0:3]) + lsum(upvals[3:4]) * first_day_fraction
+            downtime_3 = lsum(downvals[0:3]) + lsum(downvals[3:4]) * first_day_fraction
+            avail_3 = float(uptime_3) / (uptime_3 + downtime_3) * 100.0
+            
+            #print "uptime %d seconds, downtime %d seconds - availability %.1f %%" \
+            #    % (uptime_30, downtime_30, avail_30)
+            
+            o[id] = (avail_3, avail_30)
         
-        return (avail_3, avail_30)
-    
+        return o
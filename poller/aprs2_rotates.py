@@ -0,0 +1,254 @@
+
+"""
+
+Rotate member selection for the DNS driver: which servers of each rotate
+are eligible, their order by score, and per-rotate statistics.
+
+If NumPy is available, all rotates can be computed at once from a columnar
+representation of the server set: one array per server property, and flat
+arrays of all rotate memberships. Otherwise, the same results are computed
+by walking the server dicts.
+
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# servers with a worse load than this (%) are not included in rotates
+max_worst_load = 80
+
+def unique(members):
+    """
+    Drop duplicate entries from a member list, keeping the order
+    """
+    return list(dict.fromkeys(members))
+
+def server_eligible(id, servers, status):
+    """
+    Check if a server is OK to be included in a rotate
+    """
+    s = status.get(id)
+    return s and s.get('status') == 'ok' and s.get('score') != None \
+        and s.get('props', {}).get('worst_load', 100) <= max_worst_load \
+        and servers.get(id).get('out_of_service') != True
+
+def server_stats(domain_members_ok, status):
+    """
+    Sum up client counts and data rates of a set of servers. The client
+    count is a whole number, the rates are floats, same as with NumPy.
+    """
+    total_clients = rate_bytes_in = rate_bytes_out = 0.0
+    for i in domain_members_ok:
+        p = status.get(i).get('props', {})
+        total_clients += p.get('clients', 0)
+        rate_bytes_in += p.get('rate_bytes_in', 0)
+        rate_bytes_out += p.get('rate_bytes_out', 0)
+    
+    return int(round(total_clients)), rate_bytes_in, rate_bytes_out
+
+def select_rotates_dict(rotates, status, servers, master_rotate):
+    """
+    Select rotate members by walking the server dicts
+    """
+    
+    o = {}
+    for domain in rotates:
+        members = unique(rotates[domain].get('members', []))
+        members_not_deleted = [i for i in members
+            if servers.get(i) and servers.get(i).get('deleted') != True]
+        members_ok = [i for i in members_not_deleted if server_eligible(i, servers, status)]
+        
+        members_ok_v4 = [i for i in members_ok if servers.get(i).get('ipv4')]
+        members_ok_v6 = [i for i in members_ok if servers.get(i).get('ipv6')]
+        
+        # For the master rotate, we only accept servers which support HTTP submit on port 8080.
+        # v6 polling for HTTP is not done currently, since for some reason
+        # python-requests does not accept IPv6 literal addresses in an URL yet.
+        # Just use the v4 polling result for now and assume IPv6 HTTP is OK.
+        if domain == master_rotate:
+            members_ok_v4 = [i for i in members_ok_v4 if status.get(i).get('props', {}).get('submit-http-8080-ipv4')]
+            members_ok_v6 = [i for i in members_ok_v6 if status.get(i).get('props', {}).get('submit-http-8080-ipv4')]
+        
+        o[domain] = {
+            'members_ok': members_ok,
+            'members_not_deleted': members_not_deleted,
+            'order_v4': sorted(members_ok_v4, key=lambda x:status.get(x).get('score')),
+            'order_v6': sorted(members_ok_v6, key=lambda x:status.get(x).get('score')),
+            'stats': server_stats(members_ok, status)
+        }
+    
+    return o
+
+class RotateEngine:
+    """
+    Columnar representation of the server set, for computing
+    all rotates at once with NumPy
+    """
+    def __init__(self, servers, status):
+        self.ids = list(servers.keys())
+        self.ids_arr = numpy.array(self.ids, dtype=object)
+        self.index = dict([(id, n) for n, id in enumerate(self.ids)])
+        
+        # the only per-server pass, collecting a row of values for each
+        # server, which are then turned into one array per column
+        rows = []
+        for id in self.ids:
+            serv = servers[id]
+            s = status.get(id)
+            not_deleted = serv.get('deleted') != True
+            has_v4 = bool(serv.get('ipv4'))
+            has_v6 = bool(serv.get('ipv6'))
+            
+            if not s or s.get('status') != 'ok' or s.get('score') == None:
+                rows.append((0.0, not_deleted, False, False, has_v4, has_v6, False, 0.0, 0.0, 0.0))
+                continue
+            
+            p = s.get('props', {})
+            ok = serv.get('out_of_service') != True
+            rows.append((s.get('score'), not_deleted, ok,
+                ok and p.get('worst_load', 100) <= max_worst_load,
+                has_v4, has_v6, bool(p.get('submit-http-8080-ipv4')),
+                p.get('clients', 0), p.get('rate_bytes_in', 0), p.get('rate_bytes_out', 0)))
+        
+        a = numpy.array(rows, dtype=float).reshape((len(rows), 10))
+        self.score = a[:, 0]
+        self.not_deleted = a[:, 1] != 0
+        # status OK, and not out of service
+        self.ok = a[:, 2] != 0
+        # ... and load is acceptable, too
+        self.eligible = a[:, 3] != 0
+        self.has_v4 = a[:, 4] != 0
+        self.has_v6 = a[:, 5] != 0
+        self.submit_http = a[:, 6] != 0
+        self.clients = a[:, 7]
+        self.rates = a[:, 8:10]
+    
+    def members(self, rotates):
+        """
+        All memberships of all rotates in flat arrays, in configured order:
+        the rotate number and the server index of each membership. A server
+        listed twice in a rotate is only taken once, as in select_rotates_dict.
+        """
+        
+        domains = list(rotates.keys())
+        index = self.index
+        idx = []
+        lengths = []
+        for domain in domains:
+            l = [index[i] for i in unique(rotates[domain].get('members', [])) if i in index]
+            idx.extend(l)
+            lengths.append(len(l))
+        
+        rot = numpy.repeat(numpy.arange(len(domains)), lengths)
+        return domains, rot, numpy.array(idx, dtype=numpy.int64)
+    
+    def split(self, rot, idx, sel, count):
+        """
+        Server ids of the selected memberships, in a list for each rotate.
+        The selected memberships must be grouped by rotate, in rotate order.
+        """
+        ids = self.ids_arr[idx[sel]].tolist()
+        ends = numpy.cumsum(numpy.bincount(rot[sel], minlength=count)).tolist()
+        
+        o = []
+        start = 0
+        for end in ends:
+            o.append(ids[start:end])
+            start = end
+        
+        return o
+    
+    def select(self, rotates, master_rotate):
+        """
+        Select the members of all rotates
+        """
+        
+        domains, rot, idx = self.members(rotates)
+        count = len(domains)
+        
+        # filters for all memberships at once
+        not_deleted = self.not_deleted[idx]
+        ok = not_deleted & self.eligible[idx]
+        ok_v4 = ok & self.has_v4[idx]
+        ok_v6 = ok & self.has_v6[idx]
+        if master_rotate in rotates:
+            http = (rot != domains.index(master_rotate)) | self.submit_http[idx]
+            ok_v4 &= http
+            ok_v6 &= http
+        
+        # totals of each rotate
+        clients = numpy.bincount(rot, weights=numpy.where(ok, self.clients[idx], 0.0), minlength=count)
+        rate_in = numpy.bincount(rot, weights=numpy.where(ok, self.rates[idx, 0], 0.0), minlength=count)
+        rate_out = numpy.bincount(rot, weights=numpy.where(ok, self.rates[idx, 1], 0.0), minlength=count)
+        
+        # sort by rotate, then score, using the rank of each score so that the
+        # sort key is a single integer. The sort is stable, so that servers with
+        # the same score stay in configured order, same as sorted().
+        scores, rank = numpy.unique(self.score, return_inverse=True)
+        order = numpy.argsort(rot * len(scores) + rank[idx], kind='stable')
+        
+        members_ok = self.split(rot, idx, numpy.flatnonzero(ok), count)
+        members_not_deleted = self.split(rot, idx, numpy.flatnonzero(not_deleted), count)
+        order_v4 = self.split(rot, idx, order[ok_v4[order]], count)
+        order_v6 = self.split(rot, idx, order[ok_v6[order]], count)
+        
+        o = {}
+        for r, domain in enumerate(domains):
+            o[domain] = {
+                'members_ok': members_ok[r],
+                'members_not_deleted': members_not_deleted[r],
+                'order_v4': order_v4[r],
+                'order_v6': order_v6[r],
+                'stats': (int(round(clients[r])), float(rate_in[r]), float(rate_out[r]))
+            }
+        
+        return o
+    
+    def total(self):
+        """
+        Statistics of the whole server set
+        """
+        
+        not_deleted = self.not_deleted
+        ok = not_deleted & self.ok
+        rates = self.rates[ok].sum(axis=0)
+        
+        return {
+            'members_ok': self.ids_arr[ok].tolist(),
+            'members_not_deleted': self.ids_arr[not_deleted].tolist(),
+            'stats': (int(round(self.clients[ok].sum())), float(rates[0]), float(rates[1]))
+        }
+
+def total_dict(servers, status):
+    """
+    Statistics of the whole server set, by walking the server dicts
+    """
+    
+    members_not_deleted = [i for i in servers.keys()
+        if servers.get(i) and servers.get(i).get('deleted') != True]
+    members_ok = [i for i in members_not_deleted
+        if status.get(i) and status.get(i).get('status') == 'ok' and status.get(i).get('score') != None
+        and servers.get(i).get('out_of_service') != True]
+    
+    return {
+        'members_ok': members_ok,
+        'members_not_deleted': members_not_deleted,
+        'stats': server_stats(members_ok, status)
+    }
+
+def select_rotates(rotates, status, servers, master_rotate, use_numpy=False):
+    """
+    Select the eligible members of each rotate, ordered by score
+    (best first) separately for IPv4 and IPv6, and sum up their statistics.
+    Returns { domain: { 'members_ok', 'members_not_deleted', 'order_v4',
+    'order_v6', 'stats': (clients, rate_bytes_in, rate_bytes_out) } },
+    and the same for the whole server set, without 'order_v4' and 'order_v6'.
+    """
+    
+    if use_numpy and numpy != None:
+        engine = RotateEngine(servers, status)
+        return engine.select(rotates, master_rotate), engine.total()
+    
+    return select_rotates_dict(rotates, status, servers, master_rotate), total_dict(servers, status)
@@ -51,6 +51,12 @@ class Score:
         # Give a bit of penalty for 0 ... N seconds of uplink uptime.
         self.uplink_uptime_penalty_time = 900 # 15 minutes
         
+        # Uplink packet rate penalty. An uplink which is connected, but
+        # delivers very few packets per second, is starving the server
+        # of data (well before it gets completely stuck).
+        self.uplink_rx_rate_min = 2.0 # packets/s
+        self.uplink_rx_rate_penalty = 300
+        
         # Too old server software version gives penalty.
         # Configure the map key as minimum software version that is "new enough",
         # value is the score penalty given to versions older than this.
@@ -156,6 +162,10 @@ class Score:
             if uplink_uptime < self.uplink_uptime_penalty_time:
                 penalty = self.uplink_uptime_penalty_time - uplink_uptime
                 self.score_add('uplink_uptime', penalty, dur_str(uplink_uptime))
+            
+            rx_rate = upl.get('rx_rate')
+            if rx_rate != None and rx_rate < self.uplink_rx_rate_min:
+                self.score_add('uplink_rate', self.uplink_rx_rate_penalty, '%.1f pkt/s' % rx_rate)
         
         #
         # Server software version
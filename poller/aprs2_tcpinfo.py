@@ -0,0 +1,65 @@
+
+"""
+
+Read the kernel's TCP round-trip time estimate from a connected socket
+(TCP_INFO, Linux only). It's a cheap latency measurement for servers which
+filter ICMP, since we open TCP connections to them anyway.
+
+"""
+
+import socket
+import struct
+
+# struct tcp_info in linux/tcp.h, from tcpi_state up to tcpi_total_retrans:
+# 8 bytes of state and flags, followed by 24 32-bit counters
+TCP_INFO_FMT = '8B24I'
+TCP_INFO_LEN = struct.calcsize(TCP_INFO_FMT)
+
+# field offsets in the unpacked tuple
+TI_RETRANSMITS = 2
+TI_RTT = 8 + 15
+TI_RTTVAR = 8 + 16
+TI_TOTAL_RETRANS = 8 + 23
+
+def tcp_info(sock):
+    """
+    Get RTT (ms), RTT variance (ms) and retransmit counters for a connected
+    TCP socket. Returns None if not available on this platform.
+    """
+    
+    if sock == None or not hasattr(socket, 'TCP_INFO'):
+        return None
+    
+    try:
+        d = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_LEN)
+    except (socket.error, ValueError):
+        return None
+    
+    if len(d) < TCP_INFO_LEN:
+        return None
+    
+    f = struct.unpack(TCP_INFO_FMT, d[0:TCP_INFO_LEN])
+    
+    # no samples yet
+    if f[TI_RTT] == 0:
+        return None
+    
+    return {
+        'rtt': f[TI_RTT] / 1000.0,
+        'rttvar': f[TI_RTTVAR] / 1000.0,
+        'retransmits': f[TI_RETRANSMITS],
+        'total_retrans': f[TI_TOTAL_RETRANS]
+    }
+
+def response_tcp_info(r):
+    """
+    Get TCP_INFO for the connection of a python-requests response.
+    The request needs to be done with stream=True, and this needs to be
+    called before the body is read, so that the connection is still attached.
+    """
+    
+    conn = getattr(r.raw, '_connection', None)
+    if conn == None:
+        conn = getattr(r.raw, 'connection', None)
+    
+    return tcp_info(getattr(conn, 'sock', None))
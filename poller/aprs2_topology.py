@@ -0,0 +1,205 @@
+
+"""
+
+Uplink topology graph. Every poll updates the uplink edges of the polled
+server (leaf => hub, and the address the hub was seen at), so that
+the whole network can be checked incrementally, without rescanning the
+status of all servers:
+
+- a server ID seen at several addresses at the same time (duplicate instance)
+- a hub with more leaves connected than expected
+- a leaf connected to a hub which is down
+
+The edges are stored compactly in Redis, so that they survive a restart.
+
+"""
+
+import threading
+import time
+import socket
+
+import aprs2_config
+
+class UplinkTopology:
+    def __init__(self, log, red, max_age=900, hub_max_leaves=40):
+        self.log = log
+        self.red = red
+        
+        # edges older than this (seconds) are not considered current any more
+        self.max_age = max_age
+        # more leaves than this on a hub is unexpected
+        self.hub_max_leaves = hub_max_leaves
+        
+        # leaf id => list of (hub id, hub address, timestamp)
+        self.edges = {}
+        # hub id => set of leaf ids connected to it
+        self.hub_leaves = {}
+        # server id => (True/False, timestamp), status of latest poll
+        self.node_ok = {}
+        
+        # old entries are expired at most this often (seconds)
+        self.expire_interval = 60
+        self.expire_t = 0
+        
+        self.lock = threading.Lock()
+    
+    def load(self):
+        """
+        Load stored edges from the database
+        """
+        
+        edges = self.red.getUplinkEdges()
+        with self.lock:
+            for leaf in edges:
+                self.set_edges(leaf, [tuple(e) for e in edges[leaf]])
+        
+        self.log.info("Uplink topology: loaded %d edges", len(edges))
+    
+    def set_edges(self, leaf, edges):
+        """
+        Replace the edges of a leaf in the in-memory graph. Lock must be held.
+        """
+        
+        for hub, addr, t in self.edges.get(leaf, []):
+            leaves = self.hub_leaves.get(hub)
+            if leaves != None:
+                leaves.discard(leaf)
+                if not leaves:
+                    del self.hub_leaves[hub]
+        
+        if not edges:
+            self.edges.pop(leaf, None)
+            return
+        
+        self.edges[leaf] = edges
+        for hub, addr, t in edges:
+            self.hub_leaves.setdefault(hub, set()).add(leaf)
+    
+    def expire(self, now, config):
+        """
+        Drop edges and poll statuses older than max_age, the same rule used
+        for the edges everywhere else, and servers which have been removed
+        from the configuration. Lock must be held. Returns the new edges
+        of the changed leaves, { leaf: edges }, to be stored in the database.
+        """
+        
+        changed = {}
+        if now - self.expire_t < self.expire_interval:
+            return changed
+        self.expire_t = now
+        
+        dropped = 0
+        for leaf in list(self.edges.keys()):
+            server = config.getServer(leaf)
+            if server == None or server.get('deleted'):
+                fresh = []
+            else:
+                fresh = [e for e in self.edges[leaf] if now - e[2] < self.max_age]
+            if len(fresh) != len(self.edges[leaf]):
+                dropped += len(self.edges[leaf]) - len(fresh)
+                self.set_edges(leaf, fresh)
+                changed[leaf] = [list(e) for e in fresh]
+        
+        for id in list(self.node_ok.keys()):
+            server = config.getServer(id)
+            if server == None or server.get('deleted') or now - self.node_ok[id][1] >= self.max_age:
+                del self.node_ok[id]
+        
+        if dropped:
+            self.log.info("Uplink topology: expired %d edges", dropped)
+        
+        return changed
+    
+    def current_addrs(self, hub, now):
+        """
+        Get the addresses a hub has recently been seen at. Lock must be held.
+        """
+        
+        addrs = {}
+        for leaf in self.hub_leaves.get(hub, ()):
+            for e_hub, addr, t in self.edges.get(leaf, []):
+                if e_hub == hub and now - t < self.max_age:
+                    addrs.setdefault(addr, []).append(leaf)
+        
+        return addrs
+    
+    def instances(self, hub, addrs, config):
+        """
+        Count how many separate instances of a server the seen addresses
+        indicate. All of the server's own configured addresses (IPv4, IPv6,
+        configured NAT prefixes) count as a single instance.
+        """
+        
+        own = 0
+        others = 0
+        for addr in addrs:
+            if ':' in addr:
+                addr_port = '[%s]:0' % addr
+            else:
+                addr_port = '%s:0' % addr
+            if config.address_index.lookup(addr_port) == hub:
+                own = 1
+            else:
+                others += 1
+        
+        return own + others
+    
+    def update(self, id, uplinks, ok, config):
+        """
+        Update the graph with the result of a poll of server 'id', and
+        return a list of [code, message] flags for the server.
+        """
+        
+        now = int(time.time())
+        edges = []
+        for upl in uplinks:
+            hub = upl.get('id')
+            if not hub or hub == 'unknown':
+                continue
+            
+            edges.append((hub, host_address(upl.get('addr_rem', '')), now))
+        
+        flags = []
+        
+        with self.lock:
+            # stored under the lock, so that a leaf polled right after does
+            # not get its new edges overwritten with the expired ones
+            expired = self.expire(now, config)
+            if expired:
+                self.red.setUplinkEdgesMulti(expired)
+            self.node_ok[id] = (ok, now)
+            self.set_edges(id, edges)
+            
+            # this server, as a hub, seen at several addresses
+            hubs = set([id] + [e[0] for e in edges])
+            for hub in sorted(hubs):
+                addrs = self.current_addrs(hub, now)
+                if len(addrs) > 1 and self.instances(hub, addrs, config) > 1:
+                    flags.append(['topo-dup', 'Server %s seen connected from several addresses: %s' % (
+                        hub, ', '.join(['%s (by %s)' % (a, ','.join(sorted(addrs[a]))) for a in sorted(addrs)]))])
+            
+            # this server, as a hub, has too many leaves
+            leaves = len(self.hub_leaves.get(id, ()))
+            if leaves > self.hub_max_leaves:
+                flags.append(['topo-fanin', 'Hub has %d leaf servers connected, more than expected %d' % (leaves, self.hub_max_leaves)])
+            
+            # this server's hub is down
+            for hub, addr, t in edges:
+                if self.node_ok.get(hub, (None, 0))[0] == False:
+                    flags.append(['topo-hubdown', 'Connected to hub %s which is down' % hub])
+        
+        self.red.setUplinkEdges(id, [list(e) for e in edges])
+        
+        return flags
+
+def host_address(addr):
+    """
+    Get the normalized host address of an "address:port" string
+    """
+    
+    packed = aprs2_config.pack_address_port(addr)
+    if packed == None:
+        return addr
+    
+    af = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+    return socket.inet_ntop(af, packed)
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+"""
+
+Benchmark rotate member selection on a synthetic server set, with and
+without NumPy, and check that both give the same results.
+
+Usage: aprs2net-bench-rotates.py [servers] [rotates] [rounds]
+
+The defaults are about 10 times the size of the current network.
+
+"""
+
+import sys
+import time
+import random
+
+import aprs2_rotates
+
+def synthetic_fleet(n_servers, n_rotates, seed=1):
+    """
+    Make up a set of servers, their status, and rotates
+    """
+    rnd = random.Random(seed)
+    
+    servers = {}
+    status = {}
+    for n in range(n_servers):
+        id = 'T2TEST%d' % n
+        servers[id] = {
+            'id': id,
+            'ipv4': '10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255),
+            'ipv6': 'fd00::%x' % n if rnd.random() < 0.6 else None,
+            'deleted': rnd.random() < 0.02,
+            'out_of_service': rnd.random() < 0.03
+        }
+        
+        if rnd.random() < 0.05:
+            status[id] = { 'status': 'fail' }
+            continue
+        
+        status[id] = {
+            'status': 'ok',
+            # whole-number scores, so that there are ties to sort stably
+            'score': float(rnd.randint(0, 200)),
+            'props': {
+                'worst_load': rnd.uniform(0, 100),
+                'clients': rnd.randint(0, 500),
+                'rate_bytes_in': rnd.uniform(0, 100000),
+                'rate_bytes_out': rnd.uniform(0, 500000),
+                'submit-http-8080-ipv4': rnd.random() < 0.8
+            }
+        }
+    
+    ids = list(servers.keys())
+    rotates = {}
+    # the master rotate has everyone, the rest have random subsets
+    rotates['rotate.aprs2.net'] = { 'members': list(ids) }
+    for n in range(n_rotates - 1):
+        members = rnd.sample(ids, rnd.randint(5, len(ids) // 4))
+        # a few servers listed twice, by mistake
+        members.extend(rnd.sample(members, 2))
+        rotates['rotate%d.aprs2.net' % n] = { 'members': members }
+    
+    return servers, status, rotates
+
+def bench(name, rounds, func):
+    t_start = time.time()
+    for n in range(rounds):
+        o = func()
+    t = (time.time() - t_start) / rounds
+    print("%-6s %8.2f ms/round" % (name, t * 1000))
+    
+    return o
+
+def same(a, b):
+    """
+    Compare selection results, allowing for float rounding in the sums
+    """
+    if a.keys() != b.keys():
+        return False
+    
+    for domain in a:
+        for k in a[domain]:
+            if k == 'stats':
+                for x, y in zip(a[domain][k], b[domain][k]):
+                    if abs(x - y) > 1e-6 * max(1.0, abs(x)):
+                        return False
+            elif a[domain][k] != b[domain][k]:
+                return False
+    
+    return True
+
+def main():
+    n_servers = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_rotates = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    
+    servers, status, rotates = synthetic_fleet(n_servers, n_rotates)
+    print("%d servers, %d rotates, %d rounds" % (n_servers, n_rotates, rounds))
+    
+    sel_dict, total_dict = bench('dict', rounds,
+        lambda: aprs2_rotates.select_rotates(rotates, status, servers, 'rotate.aprs2.net', use_numpy=False))
+    
+    if aprs2_rotates.numpy == None:
+        print("NumPy not installed, skipping the vectorised version")
+        return 0
+    
+    sel_np, total_np = bench('numpy', rounds,
+        lambda: aprs2_rotates.select_rotates(rotates, status, servers, 'rotate.aprs2.net', use_numpy=True))
+    
+    if not same(sel_dict, sel_np) or not same({ 'total': total_dict }, { 'total': total_np }):
+        print("MISMATCH between dict and numpy results")
+        return 1
+    
+    print("Results match")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
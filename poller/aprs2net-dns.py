@@ -9,6 +9,8 @@ import traceback
 import types
 import socket
 import math
+import concurrent.futures
+import threading
 from urllib.parse import urlparse
 
 import requests
@@ -17,18 +19,61 @@ import json
 import aprs2_redis
 import aprs2_config
 import aprs2_graphite
+import aprs2_logqueue
+import aprs2_metrics
+import aprs2_push
+import aprs2_rotates
 from aprs2_cloudflare import aprs2cf
 
 # dnspython.org
+import dns.exception
 import dns.query
+import dns.rdatatype
 import dns.tsigkeyring
 import dns.update
+import dns.zone
 
 # All configuration variables need to be strings originally.
 CONFIG_SECTION = 'dns'
 DEFAULT_CONF = {
-    # Server polling interval
+    # Server polling interval. With push mode, DNS is recomputed as soon as
+    # pushed results change something, and this is the maximum time
+    # between recomputes.
     'poll_interval': '120',
+    # Wait this long after a pushed change before recomputing, so that
+    # changes coming in at about the same time are handled together (seconds)
+    'recompute_debounce': '3',
+    
+    # Max number of log records waiting to be written, further ones are dropped
+    'log_queue_size': '10000',
+    
+    # Spool file for Graphite metrics while Graphite is unreachable (empty: none),
+    # its max size in bytes, and replay rate after reconnect (metrics/s)
+    'graphite_spool': 'graphite-spool-dns.dat',
+    'graphite_spool_max': '52428800',
+    'graphite_replay_rate': '1000',
+    
+    # Status is fetched from all pollers concurrently; merging starts when
+    # all have answered, or this many seconds have passed
+    'fetch_deadline': '15',
+    # Quorum mode: start merging as soon as this many pollers have returned
+    # a good status set (0: wait for all). Answers arriving later are
+    # folded into the next cycle.
+    'fetch_quorum': '0',
+    # Only changed servers are fetched from pollers which support it,
+    # with a full resync at least this often (seconds)
+    'fetch_full_interval': '3600',
+    
+    # Push mode: listen for poll results pushed by the pollers (empty: disabled),
+    # and the shared keys of the pollers: "poller1.example.com:8036=key1 ..."
+    # While a poller keeps pushing, its status is not fetched, except for
+    # the periodic full resync.
+    'push_listen': '',
+    'push_keys': '',
+    
+    # Select rotate members using NumPy, if it is installed (python3-numpy).
+    # Only pays off on much larger server sets than the current one.
+    'rotate_numpy': '0',
     
     'max_test_result_age': '660',
     'min_polled_servers': '80',
@@ -44,12 +89,19 @@ DEFAULT_CONF = {
     'dns_master': '',
     'dns_zones': '',
     'dns_tsig_key': '',
+    # Changes to BIND are sent in UPDATE messages of up to this many names
+    # per zone, over a single TCP connection
+    'dns_update_batch': '100',
 
     'cloudflare_zones': '',
     'cloudflare_token': '',
     
     # DNS TTL
     'dns_ttl': '600',
+    
+    # Serve internal metrics in OpenMetrics format at http://host:port/metrics
+    # (empty: disabled)
+    'metrics_listen': '127.0.0.1:9122',
 }
 
 class DNSDriver:
@@ -73,6 +125,13 @@ class DNSDriver:
             
         self.config.read(config_file)
         
+        # move log I/O to a background thread
+        self.log_queue = aprs2_logqueue.LogQueue(self.config.getint(CONFIG_SECTION, 'log_queue_size'))
+        
+        aprs2_graphite.configure(self.config.get(CONFIG_SECTION, 'graphite_spool'),
+            self.config.getint(CONFIG_SECTION, 'graphite_spool_max'),
+            self.config.getint(CONFIG_SECTION, 'graphite_replay_rate'))
+        
         self.dns_master = self.config.get(CONFIG_SECTION, 'dns_master')
         self.poll_interval = self.config.getint(CONFIG_SECTION, 'poll_interval')
         self.dns_zones = self.config.get(CONFIG_SECTION, 'dns_zones').split(' ')
@@ -95,12 +154,41 @@ class DNSDriver:
             self.dns_cloudflare = aprs2cf(logging.getLogger('cloudflare'), cloudflare_token, cloudflare_zones)
     
         self.dns_ttl = self.config.getint(CONFIG_SECTION, 'dns_ttl')
+        self.dns_update_batch = self.config.getint(CONFIG_SECTION, 'dns_update_batch')
         
         self.rhead = {'User-agent': 'aprs2net-dns/2.0'}
         self.http_timeout = 10.0
+        self.fetch_deadline = self.config.getfloat(CONFIG_SECTION, 'fetch_deadline')
+        self.fetch_quorum = self.config.getint(CONFIG_SECTION, 'fetch_quorum')
+        self.fetch_full_interval = self.config.getint(CONFIG_SECTION, 'fetch_full_interval')
+        self.recompute_debounce = self.config.getfloat(CONFIG_SECTION, 'recompute_debounce')
+        self.rotate_numpy = self.config.getboolean(CONFIG_SECTION, 'rotate_numpy')
+        
+        # Fetch from all pollers at the same time, each with its own
+        # keep-alive session. Only one fetch per poller is running at a time.
+        # fetch_running: url => fetch which has not been used in a merge yet
+        self.fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.pollers)))
+        self.fetch_sessions = {}
+        self.fetch_running = {}
+        # url => status of the poller's servers, and its change feed position
+        self.fetch_cache = {}
+        # url => (request, ETag, full status) of the previous fetch, so that
+        # an unchanged status does not need to be transferred or decoded again
+        self.fetch_etags = {}
+        # protects fetch_cache and fetch_etags, which pushes update too
+        self.fetch_lock = threading.Lock()
+        for url in self.pollers:
+            session = requests.Session()
+            session.headers.update(self.rhead)
+            self.fetch_sessions[url] = session
         
-        # cache DNS state for each name, to prevent updates which do not change anything
+        # cache DNS state for each name, to prevent updates which do not change anything.
+        # Persisted in Redis, and reconciled with the real zone contents at startup.
         self.dns_update_cache = {}
+        # names whose cache entry has changed since it was last saved to Redis
+        self.dns_cache_dirty = set()
+        # changes waiting to be sent to BIND by dns_flush: zone => { fqdn: (logid, v4_addrs, v6_addrs, cname) }
+        self.dns_bind_pending = {}
         
         # config object for the web UI
         self.web_config = {
@@ -117,67 +205,409 @@ class DNSDriver:
         	self.config.get(CONFIG_SECTION, 'portal_rotates_url'),
         	self.unmanaged_rotates)
         self.config_manager.start()
+        
+        self.metrics_setup()
+        self.push_setup()
+    
+    def push_setup(self):
+        """
+        Start receiving pushed poll results, if configured
+        """
+        
+        # poller site id => url, and time of latest push from it
+        self.push_sites = dict([(urlparse(url).netloc, url) for url in self.pollers])
+        self.push_t = {}
+        
+        # set when pushed results change something which needs a DNS recompute
+        self.recompute = threading.Event()
+        # from the latest recompute: server id => rotates it is a member of,
+        # and rotate => score of the worst server included (if some were left out)
+        self.rotate_members = {}
+        self.rotate_cutoffs = {}
+        
+        listen = self.config.get(CONFIG_SECTION, 'push_listen')
+        if not listen:
+            return
+        
+        keys = {}
+        for i in self.config.get(CONFIG_SECTION, 'push_keys').split():
+            site, sep, key = i.partition('=')
+            if not sep or not key:
+                self.log.error("Invalid push_keys entry, expected site=key: %r", i)
+                continue
+            if site not in self.push_sites:
+                self.log.error("push_keys: %s is not in the pollers list", site)
+                continue
+            keys[site] = key
+        
+        self.push_receiver = aprs2_push.PushReceiver(logging.getLogger('push'), keys, self.push_received)
+        self.push_receiver.start(listen)
+    
+    def push_received(self, site, servers):
+        """
+        Fold pushed poll results into the cached status of the poller
+        """
+        
+        url = self.push_sites[site]
+        updated = 0
+        changes = []
+        
+        with self.fetch_lock:
+            cache = self.fetch_cache.get(url)
+            if cache == None:
+                # needs a full fetch first
+                self.log.info("%s: Pushed status of %d servers before initial fetch, ignored", site, len(servers))
+                return
+            
+            for s in servers:
+                id = s.get('config', {}).get('id')
+                last_test = s.get('status', {}).get('last_test')
+                if not id or last_test == None:
+                    continue
+                
+                old = cache['servers'].get(id)
+                if old != None and old.get('status', {}).get('last_test', 0) > last_test:
+                    continue
+                
+                cache['servers'][id] = s
+                updated += 1
+                
+                if old != None:
+                    change = self.push_change(id, old.get('status', {}), s.get('status', {}))
+                    if change:
+                        changes.append(change)
+            
+            # the cached status has changed, a 304 can't be trusted any more
+            self.fetch_etags.pop(url, None)
+            self.push_t[url] = time.time()
+        
+        self.m_pushed.inc(updated, poller=site)
+        self.log.debug("%s: Pushed status: %d/%d servers updated", site, updated, len(servers))
+        
+        if changes:
+            self.log.info("%s: Pushed status changes, recomputing DNS: %s", site, ', '.join(changes))
+            self.recompute.set()
+    
+    def push_change(self, id, old, new):
+        """
+        Check if a pushed status of a server has changed in a way which
+        might change DNS: status changed, or score crossed the cut-off
+        of a rotate. Returns a description of the change, or None.
+        """
+        
+        if old.get('status') != new.get('status'):
+            return '%s %s => %s' % (id, old.get('status'), new.get('status'))
+        
+        old_score = old.get('props', {}).get('score')
+        new_score = new.get('props', {}).get('score')
+        if old_score == None or new_score == None:
+            return None
+        
+        for domain in self.rotate_members.get(id, []):
+            cutoff = self.rotate_cutoffs.get(domain)
+            if cutoff != None and (old_score <= cutoff) != (new_score <= cutoff):
+                return '%s score %.1f => %.1f, %s cut-off %.1f' % (id, old_score, new_score, domain, cutoff)
+        
+        return None
+    
+    def push_fresh(self, url):
+        """
+        Check if a poller has been pushing its results recently, and its
+        cached status can be used without fetching
+        """
+        
+        now = time.time()
+        with self.fetch_lock:
+            cache = self.fetch_cache.get(url)
+            return cache != None and now - self.push_t.get(url, 0) < self.poll_interval * 2 \
+                and now - cache['full_t'] < self.fetch_full_interval
+    
+    def metrics_setup(self):
+        """
+        Set up internal metrics, and start the metrics HTTP server
+        """
+        
+        self.m_fetch_t = aprs2_metrics.histogram('aprs2_dns_fetch_seconds', 'Duration of status fetches from pollers', ('poller',))
+        self.m_fetch_bytes = aprs2_metrics.counter('aprs2_dns_fetch_bytes', 'Bytes of status transferred from pollers', ('poller', 'type'))
+        self.m_pushed = aprs2_metrics.counter('aprs2_dns_pushed_servers', 'Server statuses received in pushes from pollers', ('poller',))
+        self.m_fetch_fail = aprs2_metrics.counter('aprs2_dns_fetch_failures', 'Failed status fetches from pollers', ('poller',))
+        self.m_round_t = aprs2_metrics.histogram('aprs2_dns_round_seconds', 'Duration of DNS driver polling rounds')
+        self.m_redis_rtt = aprs2_metrics.histogram('aprs2_redis_rtt_seconds', 'Redis round-trip time',
+            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+        self.m_push = aprs2_metrics.counter('aprs2_dns_pushes', 'DNS updates pushed', ('backend', 'result'))
+        self.m_push_t = aprs2_metrics.histogram('aprs2_dns_push_seconds', 'Duration of DNS update pushes', ('backend',))
+        aprs2_metrics.counter('aprs2_log_dropped', 'Log records dropped due to a full log queue', func=self.log_queue.dropped)
+        aprs2_graphite.register_metrics()
+        
+        listen = self.config.get(CONFIG_SECTION, 'metrics_listen')
+        if listen:
+            aprs2_metrics.start_server(self.log, listen)
     
     def fetch_full_status(self):
         """
-        Fetch full status from each of the masters
+        Fetch full status from each of the masters, concurrently
         """
         
-        status_set = {}
+        # answers which arrived after the previous merge
+        late = {}
+        # up-to-date status pushed by the poller
+        answers = {}
+        # pollers whose status was taken from the push cache
+        pushed = 0
         
+        futures = {}
+        for url in self.pollers:
+            f = self.fetch_running.get(url)
+            if f != None:
+                if not f.done():
+                    self.log.error("%s: Previous status fetch still running, skipping", urlparse(url).netloc)
+                    continue
+                
+                # used, unless a fresh answer arrives in time
+                late_set = self.fetch_result(url, f)
+                if late_set != None:
+                    late[url] = late_set
+                del self.fetch_running[url]
+            
+            if self.push_fresh(url):
+                answer_set = self.check_answer(url, self.cached_status(url))
+                if answer_set != None:
+                    answers[url] = answer_set
+                    pushed += 1
+                    continue
+            
+            futures[url] = self.fetch_running[url] = self.fetch_pool.submit(self.fetch_poller, url)
+        
+        quorum = len(futures) + len(answers)
+        if self.fetch_quorum > 0:
+            quorum = min(self.fetch_quorum, quorum)
+        
+        pending = set(futures.values())
+        deadline = time.monotonic() + self.fetch_deadline
+        while pending and len(answers) < quorum:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            
+            done, pending = concurrent.futures.wait(pending, timeout=left, return_when=concurrent.futures.FIRST_COMPLETED)
+            for url, f in futures.items():
+                if f in done:
+                    del self.fetch_running[url]
+                    answer_set = self.fetch_result(url, f)
+                    if answer_set != None:
+                        answers[url] = answer_set
+        
+        if len(answers) < quorum:
+            for url, f in futures.items():
+                if f in pending:
+                    siteid = urlparse(url).netloc
+                    self.log.error("%s: HTTP full JSON status fetch: no answer within %.0f s deadline", siteid, self.fetch_deadline)
+                    self.m_fetch_fail.inc(poller=siteid)
+        
+        # merge the answers in configured order, so that the result is deterministic
+        status_set = {}
+        included = []
         for url in self.pollers:
-            self.log.info("Fetching status: %s", url)
             siteid = urlparse(url).netloc
+            answer_set = answers.get(url)
+            if answer_set == None:
+                answer_set = late.get(url)
+                if answer_set == None:
+                    continue
+                included.append(siteid + ' (late)')
+            else:
+                included.append(siteid)
             
-            t_start = time.time()
+            for id in answer_set:
+                status_set.setdefault(id, {}).update(answer_set[id])
+        
+        self.log.info("Merging status from %d/%d pollers (quorum %d, %d pushing): %s",
+            len(included), len(self.pollers), quorum, pushed, ', '.join(included))
+        
+        return status_set
+    
+    def fetch_result(self, url, f):
+        """
+        Check the result of a finished fetch, returns the status set of
+        the poller, or None if it's no good
+        """
+        
+        return self.check_answer(url, f.result())
+    
+    def check_answer(self, url, j):
+        """
+        Check the full status of a poller, returns its status set or None
+        """
+        
+        if j == None:
+            return None
+        
+        answer_set = {}
+        if not self.check_returned_status(urlparse(url).netloc, j, answer_set):
+            return None
+        
+        return answer_set
+    
+    def cached_status(self, url):
+        """
+        Get the cached full status of a poller
+        """
+        
+        with self.fetch_lock:
+            cache = self.fetch_cache.get(url)
+            if cache == None:
+                return None
             
-            try:
-                r = requests.get('%sapi/full' % url, headers=self.rhead, timeout=self.http_timeout)
-                d = r.content
-            except Exception as e:
-                self.log.error("%s: HTTP full JSON status fetch: Connection error: %s", siteid, str(e))
-                continue
+            return { 'result': 'full', 'servers': list(cache['servers'].values()) }
+    
+    def fetch_poller(self, url):
+        """
+        Fetch status from a single poller, returns the full status JSON or None.
+        If we have the poller's earlier status, only the changes since then
+        are fetched.
+        """
+        
+        self.log.info("Fetching status: %s", url)
+        siteid = urlparse(url).netloc
+        
+        with self.fetch_lock:
+            cache = self.fetch_cache.get(url)
+            if cache != None and time.time() - cache['full_t'] < self.fetch_full_interval:
+                path = 'api/delta'
+                params = { 'since': cache['seq'], 'epoch': cache['epoch'] }
+            else:
+                path = 'api/full'
+                params = None
+            prev = self.fetch_etags.get(url)
+        
+        request = (path, tuple(sorted(params.items())) if params else None)
+        headers = { 'Accept-Encoding': 'gzip, deflate' }
+        if prev != None and prev[0] == request:
+            headers['If-None-Match'] = prev[1]
+        
+        t_start = time.time()
+        
+        try:
+            r = self.fetch_sessions[url].get('%s%s' % (url, path), params=params, headers=headers, timeout=self.http_timeout)
+            d = r.content
+        except Exception as e:
+            self.log.error("%s: HTTP %s JSON status fetch: Connection error: %s", siteid, path, str(e))
+            self.m_fetch_fail.inc(poller=siteid)
+            return None
+        
+        if r.status_code == 304 and prev != None:
+            self.m_fetch_t.observe(time.time() - t_start, poller=siteid)
+            self.log.debug("%s: HTTP GET /%s: not modified", siteid, path)
+            return prev[2]
+        
+        if r.status_code != 200:
+            self.log.error("%s: HTTP %s JSON status fetch: Status code %d", siteid, path, r.status_code)
+            self.m_fetch_fail.inc(poller=siteid)
+            return None
+        
+        t_end = time.time()
+        t_dur = t_end - t_start
+        self.m_fetch_t.observe(t_dur, poller=siteid)
+        
+        # bytes transferred, before decompression
+        wire_len = r.raw.tell() if hasattr(r.raw, 'tell') else len(d)
+        
+        self.log.debug("%s: HTTP GET /%s returned: %r, %d bytes, %d transferred (%s) (%.3f s)", siteid, path, r.status_code,
+            len(d), wire_len, r.headers.get('Content-Encoding', 'uncompressed'), t_dur)
+        
+        try:
+            j = json.loads(d)
+        except Exception as e:
+            self.log.error("%s: JSON parsing failed: %r", url, e)
+            return None
+        
+        self.m_fetch_bytes.inc(wire_len, poller=siteid, type=j.get('result', 'unknown'))
+        
+        with self.fetch_lock:
+            full = self.apply_fetched_status(url, siteid, j)
             
-            if r.status_code != 200:
-                self.log.error("%s: HTTP full JSON status fetch: Status code %d", siteid, r.status_code)
-                continue
+            etag = r.headers.get('ETag')
+            if etag and full != None:
+                self.fetch_etags[url] = (request, etag, full)
+            else:
+                self.fetch_etags.pop(url, None)
+        
+        return full
+    
+    def apply_fetched_status(self, url, siteid, j):
+        """
+        Update the cached status of a poller with a full status or a delta,
+        returns the poller's full status. fetch_lock must be held.
+        """
+        
+        statusseq = j.get('statusseq')
+        
+        if j.get('result') == 'delta':
+            cache = self.fetch_cache.get(url)
+            if cache == None or not statusseq:
+                self.log.error("%s: Unexpected status delta", siteid)
+                self.fetch_cache.pop(url, None)
+                return None
             
-            t_end = time.time()
-            t_dur = t_end - t_start
+            for s in j.get('servers', []):
+                id = s.get('config', {}).get('id')
+                if not id:
+                    continue
+                # a pushed status might be more recent
+                old = cache['servers'].get(id)
+                if old != None and old.get('status', {}).get('last_test', 0) > s.get('status', {}).get('last_test', 0):
+                    continue
+                cache['servers'][id] = s
+            for id in j.get('deleted', []):
+                cache['servers'].pop(id, None)
+            cache['seq'] = statusseq.get('seq')
             
-            self.log.debug("%s: HTTP GET /api/full returned: %r (%.3f s)", siteid, r.status_code, t_dur)
+            self.log.info("%s: Status delta: %d servers changed, %d removed, seq %r",
+                siteid, len(j.get('servers', [])), len(j.get('deleted', [])), cache['seq'])
             
-            try:
-                j = json.loads(d)
-            except Exception as e:
-                self.log.error("%s: JSON parsing failed: %r", url, e)
-                continue
+            return { 'result': 'full', 'servers': list(cache['servers'].values()) }
+        
+        if statusseq and type(j.get('servers')) is list:
+            # poller supports the change feed, use deltas next time
+            servers = {}
+            for s in j['servers']:
+                id = s.get('config', {}).get('id')
+                if id:
+                    servers[id] = s
             
-            self.check_returned_status(siteid, j, status_set)
+            self.fetch_cache[url] = {
+                'seq': statusseq.get('seq'),
+                'epoch': statusseq.get('epoch'),
+                'full_t': time.time(),
+                'servers': servers
+            }
+        else:
+            self.fetch_cache.pop(url, None)
         
-        return status_set
+        return j
     
     def check_returned_status(self, siteid, j, status_set):
         """
-        Check if the returned full status set is any good
+        Check if the returned full status set is any good, and add its
+        servers to the status set if it is
         """
         
         if j.get('result') != 'full' and j.get('result') != 'ok':
             self.log.error("%s: Full status JSON does not have result: ok/full", siteid)
-            return
+            return False
         
         servers = j.get('servers')
         if not servers:
             self.log.error("%s: Full status JSON does not contain servers", siteid)
-            return
+            return False
         
         if not type(servers) is list:
             self.log.error("%s: Full status JSON: servers is not a list", siteid)
-            return
+            return False
         
         if len(servers) < self.min_polled_servers:
             self.log.error("%s: %d servers polled - too few (min %d)!", siteid, len(servers), self.min_polled_servers)
-            return
+            return False
         
         # Check that a good amount of servers in the set are OK,
         # discard the whole set if the poller itself is in trouble.
@@ -188,10 +618,12 @@ class DNSDriver:
         if servers_ok_pct < self.min_polled_ok_pct:
             self.log.error("%s: Too few servers OK (%d/%d: %.1f %% < %.0f %%) - poller having trouble?",
                 siteid, len(servers_ok), len(servers), servers_ok_pct, self.min_polled_ok_pct)
-            return
+            return False
         
         for s in servers:
             self.add_returned_server(siteid, s, status_set)
+        
+        return True
     
     def add_returned_server(self, siteid, s, status_set):
         """
@@ -232,6 +664,13 @@ class DNSDriver:
         
         merged = {}
         
+        # Redis is accessed in bulk: previous statuses are loaded at once,
+        # and availability updates and merged statuses written in pipelines
+        prev_states = self.red.getServerStatuses()
+        avail_updates = []
+        # id => intermediate merge results, for the second pass
+        pending = {}
+        
         for id in status_set:
             ok_count = 0
             scores = []
@@ -294,13 +733,15 @@ class DNSDriver:
                 'c_res': len(status_set[id])
             }
             
+            # The props are copied, since the merged score is written in them,
+            # and the fetched statuses are cached and merged again later.
             if latest:
                 if 'props' in latest:
-                    m['props'] = latest.get('props')
+                    m['props'] = dict(latest.get('props') or {})
                 m['last_test'] = latest.get('last_test')
             
             if not 'props' in m and props_any != None:
-                m['props'] = props_any
+                m['props'] = dict(props_any)
             
             if errors:
                 m['errors'] = [[k, errors[k]] for k in errors]
@@ -314,7 +755,7 @@ class DNSDriver:
             #    m['s_fail'] = latest_fail
             
             # retain some properties
-            prev_state = self.red.getServerStatus(id)
+            prev_state = prev_states.get(id)
             if not prev_state or status != prev_state.get('status') or not prev_state.get('last_change'):
                 m['last_change'] = m.get('last_test')
             else:
@@ -331,10 +772,19 @@ class DNSDriver:
                     self.log.debug("server out_of_service, not updating availability stats")
                 else:
                     if tdif > 0 and tdif < self.poll_interval * 3:
-                        m['avail_3'], m['avail_30'] = self.red.updateAvail(id, tdif, m['status'] == 'ok')
+                        avail_updates.append((id, tdif, m['status'] == 'ok'))
                     else:
                         self.log.debug("tdif %d not good, using old availability stats", tdif)
             
+            pending[id] = (scores, score_sum, merged_scorebase, server, props_any)
+        
+        for id, avail in self.red.updateAvailMulti(avail_updates).items():
+            merged[id]['avail_3'], merged[id]['avail_30'] = avail
+        
+        for id in pending:
+            m = merged[id]
+            scores, score_sum, merged_scorebase, server, props_any = pending[id]
+            
             # calculate availability penalty for score
             availability_score = 0
             if 'avail_3' in m and m['avail_3'] != None and m['avail_3'] < 99.98:
@@ -347,7 +797,7 @@ class DNSDriver:
                 if availability_score > 0:
                     m['score'] += availability_score
                     merged_scorebase['master'] = { "availability": [availability_score, "%.3f %%" % m['avail_3'] ] }
-                if m['props']:
+                if m.get('props'):
                     m['props']['score'] = m['score']
                 # just for the heading on the merged scorebase table, this needs to have
                 # all the score components
@@ -360,10 +810,6 @@ class DNSDriver:
             if merged_scorebase:
                 m['merged_scorebase'] = merged_scorebase
             
-            # store state in local database
-            #self.log.debug("merged status for %s: %r", id, m)
-            self.red.setServerStatus(id, m)
-            
             # push statistics (through a buffer and thread) to graphite
             if server:
                 graphite_sender = aprs2_graphite.GraphiteSender(self.log, "server." + server["id"])
@@ -378,6 +824,9 @@ class DNSDriver:
                         if k in props_any:
                             graphite_sender.send(k, props_any.get(k))
         
+        # store state in local database
+        self.red.setServerStatuses(merged)
+        
         return merged
     
     def update_dns(self, servers, merged_status):
@@ -387,58 +836,54 @@ class DNSDriver:
         
         # Fetch setup from database (maintaned by config manager thread)
         rotates = self.red.getRotates()
+        managed = dict([(d, rotates[d]) for d in rotates if d not in self.unmanaged_rotates])
+        
+        # Select the members of all rotates in one go
+        t_start = time.time()
+        selected, total = aprs2_rotates.select_rotates(managed, merged_status, servers,
+            self.master_rotate, use_numpy=self.rotate_numpy)
+        self.log.debug("Rotate selection for %d rotates, %d servers took %.3f s",
+            len(managed), len(servers), time.time() - t_start)
         
         # Which servers are taking part in one of the rotations
         participating_servers = {}
+        # statistics of each rotate
+        self.rotate_stats = {}
         
-        for d in rotates:
-            if d in self.unmanaged_rotates:
-                continue
-            self.update_dns_rotate(d, rotates[d], merged_status, servers, participating_servers)
+        rotate_members = {}
+        for d in managed:
+            for i in managed[d].get('members', []):
+                rotate_members.setdefault(i, []).append(d)
+            self.update_dns_rotate(d, managed[d], selected[d], merged_status, servers, participating_servers)
+        self.rotate_members = rotate_members
         
         # Push the addresses of individual servers
         self.update_dns_hosts(servers, merged_status)
         
+        # Send the changes collected above to BIND
+        self.dns_flush()
+        self.dns_cache_save()
+        
         #self.log.debug("participating servers: %r", participating_servers)
         self.red.storeRotateStatus(participating_servers)
         
-        self.update_total_stats(servers, merged_status)
+        self.store_rotate_stats('total', total)
+        self.red.storeRotateStatsMulti(self.rotate_stats)
     
-    def update_dns_rotate(self, domain, domain_conf, status, servers, participating_servers):
+    def update_dns_rotate(self, domain, domain_conf, sel, status, servers, participating_servers):
         """
-        Update a single DNS rotate
+        Update a single DNS rotate, with the members selected by aprs2_rotates
         """
         self.log.info("Processing rotate %s ...", domain)
         #self.log.debug("Checking rotate %s: %r", domain, domain_conf)
         
-        # which members are OK, and which of them have IPv4 or IPv6 addresses available
-        members = domain_conf.get('members')
-        members_not_deleted = [i for i in members
-            if servers.get(i) and servers.get(i).get('deleted') != True]
-        members_ok = [i for i in members_not_deleted
-            if status.get(i) and status.get(i).get('status') == 'ok' and status.get(i).get('score') != None
-            and status.get(i).get('props', {}).get('worst_load', 100) <= 80
-            and servers.get(i).get('out_of_service') != True]
-            
-        
-        members_ok_v4 = [i for i in members_ok if servers.get(i).get('ipv4')]
-        members_ok_v6 = [i for i in members_ok if servers.get(i).get('ipv6')]
-        
-        # For the master rotate, we only accept servers which support HTTP submit on port 8080.
-        if domain == self.master_rotate:
-            members_ok_v4 = [i for i in members_ok_v4 if status.get(i).get('props', {}).get('submit-http-8080-ipv4')]
-            # v6 polling for HTTP is not done currently, since for some reason
-            # python-requests does not accept IPv6 literal addresses in an URL yet.
-            # Just use the v4 polling result for now and assume IPv6 HTTP is OK.
-            members_ok_v6 = [i for i in members_ok_v6 if status.get(i).get('props', {}).get('submit-http-8080-ipv4')]
+        # members which are OK, with IPv4 or IPv6 addresses available, sorted by score
+        scored_order_v4 = sel['order_v4']
+        scored_order_v6 = sel['order_v6']
         
-        self.log.debug("Members: %r", members)
-        self.log.debug("Members ok ip4: %r", members_ok_v4)
-        self.log.debug("Members ok ip6: %r", members_ok_v6)
-        
-        # sort by score
-        scored_order_v4 = sorted(members_ok_v4, key=lambda x:status.get(x).get('score'))
-        scored_order_v6 = sorted(members_ok_v6, key=lambda x:status.get(x).get('score'))
+        self.log.debug("Members: %r", domain_conf.get('members'))
+        self.log.debug("Members ok ip4: %r", scored_order_v4)
+        self.log.debug("Members ok ip6: %r", scored_order_v6)
         
         # Adjust the sizes of rotates: Number of entries * 0.55, so that
         # load balancing happens even in smaller rotates (the few servers with
@@ -459,6 +904,12 @@ class DNSDriver:
         limited_order_v4 = scored_order_v4[0:v4_limit]
         limited_order_v6 = scored_order_v6[0:v6_limit]
         
+        # a score change across the cut-off changes the rotate
+        if limited_order_v4 and len(scored_order_v4) > v4_limit:
+            self.rotate_cutoffs[domain] = status.get(limited_order_v4[-1]).get('score')
+        else:
+            self.rotate_cutoffs.pop(domain, None)
+        
         self.log.info("Scored order ip4: %r", [(i, '%.1f' % status.get(i).get('score')) for i in limited_order_v4])
         self.log.info("Left out     ip4: %r", [(i, '%.1f' % status.get(i).get('score')) for i in scored_order_v4[v4_limit:]])
         self.log.info("Scored order ip6: %r", [(i, '%.1f' % status.get(i).get('score')) for i in limited_order_v6])
@@ -486,42 +937,25 @@ class DNSDriver:
         
         self.dns_push(domain, domain, v4_addrs=v4_addrs, v6_addrs=v6_addrs)
         
-        self.store_rotate_stats(domain, members_ok, members_not_deleted, status)
-
-    def update_total_stats(self, servers, status):
-        """
-        Calculate and store statistics for the whole server set
-        """
+        self.store_rotate_stats(domain, sel)
     
-        # which servers are OK
-        members = servers.keys()
-        members_not_deleted = [i for i in members
-            if servers.get(i) and servers.get(i).get('deleted') != True]
-        members_ok = [i for i in members_not_deleted
-            if status.get(i) and status.get(i).get('status') == 'ok' and status.get(i).get('score') != None
-            and servers.get(i).get('out_of_service') != True]
-        
-        self.store_rotate_stats('total', members_ok, members_not_deleted, status)
-        
-    def store_rotate_stats(self, domain, members_ok, members_not_deleted, status):
+    def store_rotate_stats(self, domain, sel):
         """
-        Calculate and store some statistics for a rotate
+        Store some statistics for a rotate
         """
-        total_clients = rate_bytes_in = rate_bytes_out = 0
-        for i in members_ok:
-            p = status.get(i).get('props', {})
-            total_clients += p.get('clients', 0)
-            rate_bytes_in += p.get('rate_bytes_in', 0)
-            rate_bytes_out += p.get('rate_bytes_out', 0)
-            
+        total_clients, rate_bytes_in, rate_bytes_out = sel['stats']
+        members_ok = sel['members_ok']
+        members_not_deleted = sel['members_not_deleted']
+        
         self.log.info("%s: %d clients on %d/%d servers, total data rate %.0f/%.0f bytes/sec in/out",
             domain, total_clients, len(members_ok), len(members_not_deleted), rate_bytes_in, rate_bytes_out)
-        self.red.storeRotateStats(domain, {
+        # stored in one go by update_dns
+        self.rotate_stats[domain] = {
             'clients': total_clients,
             'servers_ok': len(members_ok), 'servers': len(members_not_deleted),
             'rate_bytes_out': rate_bytes_out,
             'rate_bytes_in': rate_bytes_in
-        })
+        }
     
     def update_dns_hosts(self, servers, merged_status):
         """
@@ -575,6 +1009,126 @@ class DNSDriver:
         
         return None
     
+    def dns_cache_key(self, v4_addrs, v6_addrs, cname):
+        """
+        DNS state of a name in dns_update_cache, addresses sorted
+        """
+        if cname != None:
+            return "CNAME " + cname
+        
+        return ' '.join(v4_addrs) + ' ' + ' '.join(v6_addrs)
+    
+    def dns_cache_save(self):
+        """
+        Store changed entries of the DNS update cache in Redis
+        """
+        if not self.dns_cache_dirty:
+            return
+        
+        dirty = self.dns_cache_dirty
+        self.dns_cache_dirty = set()
+        
+        self.red.setDnsCache(dict([(fqdn, self.dns_update_cache[fqdn]) for fqdn in dirty if fqdn in self.dns_update_cache]))
+        self.red.delDnsCache([fqdn for fqdn in dirty if fqdn not in self.dns_update_cache])
+    
+    def dns_state_keys(self, names):
+        """
+        Convert { fqdn: { 'v4': [...], 'v6': [...], 'cname': ... } } to
+        { fqdn: cache_key }
+        """
+        return dict([(fqdn, self.dns_cache_key(sorted(n['v4']), sorted(n['v6']), n['cname']))
+            for fqdn, n in names.items()])
+    
+    def dns_zone_bind(self, zone):
+        """
+        Get the current state of a zone from the DNS master, with AXFR
+        """
+        try:
+            z = dns.zone.from_xfr(dns.query.xfr(self.dns_master, zone,
+                keyring=self.dns_keyring, keyalgorithm="hmac-sha256", timeout=30))
+        except Exception as e:
+            self.log.error("DNS cache: zone transfer of %s from %s failed: %r", zone, self.dns_master, e)
+            return None
+        
+        names = {}
+        for name, node in z.nodes.items():
+            fqdn = name.derelativize(z.origin).to_text(omit_final_dot=True)
+            n = { 'v4': [], 'v6': [], 'cname': None }
+            for rds in node.rdatasets:
+                if rds.rdtype == dns.rdatatype.A:
+                    n['v4'].extend([r.address for r in rds])
+                elif rds.rdtype == dns.rdatatype.AAAA:
+                    n['v6'].extend([r.address for r in rds])
+                elif rds.rdtype == dns.rdatatype.CNAME:
+                    for r in rds:
+                        n['cname'] = r.target.derelativize(z.origin).to_text(omit_final_dot=True)
+            names[fqdn] = n
+        
+        return self.dns_state_keys(names)
+    
+    def dns_zone_cloudflare(self, zone):
+        """
+        Get the current state of a zone from Cloudflare, with a single listing
+        """
+        if zone not in self.dns_cloudflare.zone_ids:
+            return None
+        
+        records = self.dns_cloudflare.list_records(zone)
+        if records == None:
+            return None
+        
+        names = {}
+        for r in records:
+            n = names.setdefault(r.get('name'), { 'v4': [], 'v6': [], 'cname': None })
+            if r.get('type') == 'A':
+                n['v4'].append(r.get('content'))
+            elif r.get('type') == 'AAAA':
+                n['v6'].append(r.get('content'))
+            elif r.get('type') == 'CNAME':
+                n['cname'] = r.get('content')
+        
+        return self.dns_state_keys(names)
+    
+    def dns_cache_load(self):
+        """
+        Load the DNS update cache from Redis, and keep only the entries
+        which match the real contents of the zones, on BIND and Cloudflare.
+        Names which differ, or whose zone could not be checked, are pushed
+        again on the first round.
+        """
+        if not self.dns_zones:
+            return
+        
+        stored = self.red.getDnsCache()
+        if not stored:
+            self.log.info("DNS cache: nothing stored, pushing all names")
+            return
+        
+        cache = {}
+        for zone in self.dns_zones:
+            zone_names = [fqdn for fqdn in stored if self.dns_pick_zone(fqdn) == zone]
+            if not zone_names:
+                continue
+            
+            actual = []
+            if self.dns_master and self.dns_keyring:
+                actual.append(self.dns_zone_bind(zone))
+            if self.dns_cloudflare:
+                actual.append(self.dns_zone_cloudflare(zone))
+            if not actual or None in actual:
+                self.log.info("DNS cache: zone %s could not be checked, pushing all of its %d names", zone, len(zone_names))
+                continue
+            
+            ok = [fqdn for fqdn in zone_names if all([a.get(fqdn) == stored[fqdn] for a in actual])]
+            for fqdn in ok:
+                cache[fqdn] = stored[fqdn]
+            
+            self.log.info("DNS cache: zone %s: %d/%d names up to date", zone, len(ok), len(zone_names))
+        
+        self.dns_update_cache = cache
+        # forget the ones which did not match
+        self.red.delDnsCache([fqdn for fqdn in stored if fqdn not in cache])
+    
     def dns_push(self, logid, fqdn, v4_addrs = [], v6_addrs = [], cname = None):
         """
         Push a set of A and AAAA records to the DNS, but only if they've
@@ -589,16 +1143,15 @@ class DNSDriver:
         v4_addrs = sorted(v4_addrs)
         v6_addrs = sorted(v6_addrs)
         if cname != None:
-            cache_key = "CNAME " + cname
             v4_addrs = v6_addrs = []
-        else:
-            cache_key = ' '.join(v4_addrs) + ' ' + ' '.join(v6_addrs)
+        cache_key = self.dns_cache_key(v4_addrs, v6_addrs, cname)
         
         if self.dns_update_cache.get(fqdn) == cache_key:
             #self.log.info("DNS push [%s]: %s - no changes", logid, fqdn)
             return
         
         self.dns_update_cache[fqdn] = cache_key
+        self.dns_cache_dirty.add(fqdn)
         
         # look up the zone file to update
         zone = self.dns_pick_zone(fqdn)
@@ -608,51 +1161,170 @@ class DNSDriver:
         
         self.log.info("DNS pushing [%s]: %s: %s", logid, fqdn, cache_key)
 
+        # BIND updates are batched per zone, and sent by dns_flush()
         if self.dns_master and self.dns_keyring:
-            self.dns_push_bind(logid, zone, fqdn, v4_addrs, v6_addrs, cname)
+            self.dns_bind_pending.setdefault(zone, {})[fqdn] = (logid, v4_addrs, v6_addrs, cname)
         
         if self.dns_cloudflare:
+            t_start = time.monotonic()
             self.dns_cloudflare.dns_push(logid, zone, fqdn, v4_addrs, v6_addrs, cname)
-
-    def dns_push_bind(self, logid, zone, fqdn, v4_addrs = [], v6_addrs = [], cname = None):
+            self.m_push_t.observe(time.monotonic() - t_start, backend='cloudflare')
+            self.m_push.inc(backend='cloudflare', result='done')
+    
+    def dns_flush(self):
         """
-        Push a set of changes to a BIND nameserver using the regular DNS protocol.
+        Send the pending BIND changes, grouped by zone into as few UPDATE
+        messages as possible, over a single TCP connection to the DNS master.
+        """
+        pending = self.dns_bind_pending
+        self.dns_bind_pending = {}
+        if not pending:
+            return
+        
+        conn = [None]
+        try:
+            for zone in pending:
+                names = list(pending[zone].items())
+                for n in range(0, len(names), self.dns_update_batch):
+                    self.dns_push_bind(conn, zone, names[n:n+self.dns_update_batch])
+        finally:
+            if conn[0] != None:
+                conn[0].close()
+    
+    def dns_bind_connect(self):
+        """
+        Open a TCP connection to the DNS master
         """
-        # add a dot to make sure bind doesn't add the zone name in the end
-        fqdn = fqdn + '.'
+        af = socket.AF_INET6 if ':' in self.dns_master else socket.AF_INET
+        sock = socket.socket(af, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        try:
+            sock.connect((self.dns_master, 53))
+        except:
+            sock.close()
+            raise
         
+        return sock
+    
+    def dns_bind_failed(self, zone, names, reason):
+        """
+        Report names which could not be updated, and forget them from the
+        update cache, so that they will be tried again on the next round
+        """
+        for fqdn, (logid, v4_addrs, v6_addrs, cname) in names:
+            self.log.error("DNS push [%s]: %s: %s: update failed: %s", logid, zone, fqdn, reason)
+            self.dns_update_cache.pop(fqdn, None)
+            self.dns_cache_dirty.add(fqdn)
+        self.m_push.inc(len(names), backend='bind', result='fail')
+    
+    def dns_push_bind(self, conn, zone, names):
+        """
+        Push a set of changes to a BIND nameserver using the regular DNS protocol.
+        names is a list of (fqdn, (logid, v4_addrs, v6_addrs, cname)), all in
+        the same zone. They are sent in one UPDATE message, in which each name's
+        records are replaced atomically. If the master refuses the message,
+        the names are retried one by one, to find out which of them failed.
+        If the connection fails while sending, the message is split in half.
+        conn is a list holding the TCP connection, opened when needed.
+        """
         update = dns.update.Update(zone, keyring=self.dns_keyring, keyalgorithm="hmac-sha256")
-        update.delete(fqdn)
-        if cname != None:
-            update.add(fqdn, self.dns_ttl, 'cname', cname + '.')
-        else:
-            for a in v4_addrs:
-                update.add(fqdn, self.dns_ttl, 'a', a)
-            for a in v6_addrs:
-                update.add(fqdn, self.dns_ttl, 'aaaa', a)
+        for fqdn, (logid, v4_addrs, v6_addrs, cname) in names:
+            # add a dot to make sure bind doesn't add the zone name in the end
+            name = fqdn + '.'
+            update.delete(name)
+            if cname != None:
+                update.add(name, self.dns_ttl, 'cname', cname + '.')
+            else:
+                for a in v4_addrs:
+                    update.add(name, self.dns_ttl, 'a', a)
+                for a in v6_addrs:
+                    update.add(name, self.dns_ttl, 'aaaa', a)
         
+        # a DNS message over TCP is limited to 64k, split if needed
         try:
-            response = dns.query.tcp(update, self.dns_master, timeout=10)
-        except socket.error as e:
-            self.log.error("DNS push [%s]: update error, cannot connect to DNS master: %r", logid, e)
+            update.to_wire()
+        except dns.exception.TooBig:
+            if len(names) < 2:
+                self.dns_bind_failed(zone, names, "too many records")
+                return
+            half = len(names) // 2
+            self.dns_push_bind(conn, zone, names[0:half])
+            self.dns_push_bind(conn, zone, names[half:])
             return
+        
+        if conn[0] == None:
+            try:
+                conn[0] = self.dns_bind_connect()
+            except Exception as e:
+                self.dns_bind_failed(zone, names, "could not connect to DNS master: %r" % e)
+                return
+            reused = False
+        else:
+            reused = True
+        
+        t_start = time.monotonic()
+        try:
+            response = dns.query.tcp(update, self.dns_master, timeout=10, sock=conn[0])
         except dns.tsig.PeerBadKey as e:
-            self.log.error("DNS push [%s]: update error, DNS master does not accept our key: %r", logid, e)
+            self.dns_bind_failed(zone, names, "DNS master does not accept our key: %r" % e)
             return
         except Exception as e:
-            self.log.error("DNS push [%s]: update error: %r", logid, e)
+            conn[0].close()
+            conn[0] = None
+            # Do not send the same message again, it may be what upset the
+            # master: split it, on new connections. A single name is only
+            # retried if the master may just have closed an idle connection.
+            if len(names) > 1:
+                self.log.info("DNS push: %s: error talking to DNS master, splitting %d names: %r", zone, len(names), e)
+                half = len(names) // 2
+                self.dns_push_bind(conn, zone, names[0:half])
+                self.dns_push_bind(conn, zone, names[half:])
+            elif reused:
+                self.dns_push_bind(conn, zone, names)
+            else:
+                self.dns_bind_failed(zone, names, "error talking to DNS master: %r" % e)
             return
-            
-        self.log.info("DNS push [%s]: Sent %s: %s - response: %s / %s", logid, zone, fqdn,
+        
+        self.m_push_t.observe(time.monotonic() - t_start, backend='bind')
+        
+        rcode = dns.rcode.from_flags(response.flags, response.ednsflags)
+        self.log.info("DNS push: Sent %s: %d names - response: %s / %s", zone, len(names),
             dns.opcode.to_text(dns.opcode.from_flags(response.flags)),
-            dns.rcode.to_text(dns.rcode.from_flags(response.flags, response.ednsflags))
+            dns.rcode.to_text(rcode)
             )
+        
+        if rcode == dns.rcode.NOERROR:
+            self.m_push.inc(len(names), backend='bind', result='ok')
+            return
+        
+        if len(names) > 1:
+            # the whole message was rejected, find the names which caused it
+            for name in names:
+                self.dns_push_bind(conn, zone, [name])
+            return
+        
+        self.dns_bind_failed(zone, names, dns.rcode.to_text(rcode))
     
     def poll(self):
         """
         Do a single polling round
         """
         
+        t_start = time.monotonic()
+        self.red.ping()
+        self.m_redis_rtt.observe(time.monotonic() - t_start)
+        
+        t_start = time.monotonic()
+        try:
+            self.poll_round()
+        finally:
+            self.m_round_t.observe(time.monotonic() - t_start)
+    
+    def poll_round(self):
+        """
+        Fetch status from the pollers, merge, and update DNS
+        """
+        
         # Fetch full status JSON from all pollers, ignoring
         # pollers which appear to be faulty
         status_set = self.fetch_full_status()
@@ -680,15 +1352,33 @@ class DNSDriver:
         Main DNS driver loop
         """
         
+        self.dns_cache_load()
+        
         while True:
+            self.recompute.clear()
             self.poll()
-            time.sleep(self.poll_interval)
-
+            self.wait_for_changes()
+    
+    def wait_for_changes(self):
+        """
+        Wait until pushed results change something in DNS, or until
+        poll_interval has passed
+        """
+        
+        deadline = time.monotonic() + self.poll_interval
+        
+        if not self.recompute.wait(self.poll_interval):
+            return
+        
+        # changes tend to come in bunches, wait for the rest of them
+        time.sleep(max(0, min(self.recompute_debounce, deadline - time.monotonic())))
 
-cfgfile = 'poller.conf'
-if len(sys.argv) > 1:
-    cfgfile = sys.argv[1]
 
-driver = DNSDriver(cfgfile)
-driver.loop()
+if __name__ == '__main__':
+    cfgfile = 'poller.conf'
+    if len(sys.argv) > 1:
+        cfgfile = sys.argv[1]
+    
+    driver = DNSDriver(cfgfile)
+    driver.loop()
 
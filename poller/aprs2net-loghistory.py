@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+"""
+
+Show the stored poll logs of a server from a time range, to see why a
+poll failed after the fact.
+
+Usage: aprs2net-loghistory.py <server id> [start] [end] [count]
+
+start and end are "YYYY-MM-DD HH:MM" (local time), unix timestamps,
+or "-" for open-ended. Without them, the latest logs are shown.
+
+"""
+
+import sys
+import time
+
+import aprs2_redis
+
+def parse_time(s):
+    if s == None or s == '-':
+        return None
+    
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(s, fmt)))
+        except ValueError:
+            pass
+    
+    raise ValueError("Invalid time: %r" % s)
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: %s <server id> [start] [end] [count]" % sys.argv[0])
+        return 1
+    
+    id = sys.argv[1]
+    try:
+        t_start = parse_time(sys.argv[2] if len(sys.argv) > 2 else None)
+        t_end = parse_time(sys.argv[3] if len(sys.argv) > 3 else None)
+    except ValueError as e:
+        print(e)
+        return 1
+    count = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    
+    # the poller's database
+    red = aprs2_redis.APRS2Redis()
+    
+    # without a range, show the latest ones
+    if t_start == None and t_end == None and count == None:
+        logs = red.getServerLogHistory(id)[-10:]
+    else:
+        logs = red.getServerLogHistory(id, t_start, t_end, count)
+    
+    if not logs:
+        print("No poll logs stored for %s in the given time range" % id)
+        return 1
+    
+    for entry in logs:
+        print("=== %s: poll at %s ===" % (id, time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(entry.get('t', 0)))))
+        print(entry.get('log', ''))
+    
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
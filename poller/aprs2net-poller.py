@@ -8,11 +8,18 @@ import configparser
 import sys
 import traceback
 
+import redis
+
 import aprs2_redis
 import aprs2_poll
 import aprs2_config
 import aprs2_logbuf
 import aprs2_graphite
+import aprs2_logqueue
+import aprs2_breaker
+import aprs2_topology
+import aprs2_metrics
+import aprs2_push
 
 # All configuration variables need to be strings originally.
 CONFIG_SECTION = 'poller'
@@ -23,6 +30,59 @@ DEFAULT_CONF = {
     # Server polling interval
     'poll_interval': '300',
     
+    # Max number of log records waiting to be written, further ones are dropped
+    'log_queue_size': '10000',
+    
+    # Spool file for Graphite metrics while Graphite is unreachable (empty: none),
+    # its max size in bytes, and replay rate after reconnect (metrics/s)
+    'graphite_spool': 'graphite-spool-poller.dat',
+    'graphite_spool_max': '52428800',
+    'graphite_replay_rate': '1000',
+    
+    # Maximum duration of a single server poll, all stages included (seconds)
+    'poll_budget': '90',
+    
+    # After this many consecutive connection failures, only do a cheap
+    # connect check on a server, with exponential backoff up to breaker_backoff_max
+    # seconds, until it responds again
+    'breaker_threshold': '5',
+    'breaker_backoff_max': '3600',
+    
+    # Duration of the ICMP ping test (seconds), and a shorter one used for
+    # servers which gave a kernel TCP RTT estimate on the previous poll
+    # (0 to skip ping for them)
+    'ping_duration': '30',
+    'ping_duration_tcp_rtt': '10',
+    
+    # Extra address prefixes for figuring out uplink servers which are
+    # seen from a NAT or an alternate address: "192.0.2.0/24=T2FOO 2001:db8::/48=T2BAR"
+    'uplink_prefixes': '',
+    
+    # Uplink topology checks: a hub with more leaf servers connected than
+    # this is flagged
+    'hub_max_leaves': '40',
+    
+    # Per-poll log stored in the database: minimum level and max lines
+    'poll_log_level': 'DEBUG',
+    'poll_log_lines': '1000',
+    
+    # History of per-poll logs: max number of logs kept per server,
+    # and max age in seconds (0: no history)
+    'poll_log_history_len': '200',
+    'poll_log_history_age': '604800',
+    
+    # Serve internal metrics in OpenMetrics format at http://host:port/metrics
+    # (empty: disabled)
+    'metrics_listen': '127.0.0.1:9121',
+    
+    # Push mode: push poll results to the DNS driver as they come in
+    # (empty push_url: disabled). push_site must match the poller's host:port
+    # in the DNS driver's pollers list, and push_key the key configured
+    # for it in the DNS driver's push_keys.
+    'push_url': '',
+    'push_site': '',
+    'push_key': '',
+    
     # Portal URL for downloading configs
     'portal_servers_url': 'https://portal-url.example.com/blah',
     'portal_rotates_url': 'https://portal-url.example.com/blah'
@@ -50,7 +110,24 @@ class Poller:
             
         self.config.read(config_file)
         
+        # move log I/O to a background thread
+        self.log_queue = aprs2_logqueue.LogQueue(self.config.getint(CONFIG_SECTION, 'log_queue_size'))
+        
+        aprs2_graphite.configure(self.config.get(CONFIG_SECTION, 'graphite_spool'),
+            self.config.getint(CONFIG_SECTION, 'graphite_spool_max'),
+            self.config.getint(CONFIG_SECTION, 'graphite_replay_rate'))
+        
         self.poll_interval = self.config.getint(CONFIG_SECTION, 'poll_interval')
+        self.poll_budget = self.config.getint(CONFIG_SECTION, 'poll_budget')
+        self.poll_log_level = logging.getLevelName(self.config.get(CONFIG_SECTION, 'poll_log_level').upper())
+        if not isinstance(self.poll_log_level, int):
+            self.log.error("Unknown poll_log_level, using DEBUG")
+            self.poll_log_level = logging.DEBUG
+        self.poll_log_lines = self.config.getint(CONFIG_SECTION, 'poll_log_lines')
+        self.poll_log_history_len = self.config.getint(CONFIG_SECTION, 'poll_log_history_len')
+        self.poll_log_history_age = self.config.getint(CONFIG_SECTION, 'poll_log_history_age')
+        self.ping_duration = self.config.getint(CONFIG_SECTION, 'ping_duration')
+        self.ping_duration_tcp_rtt = self.config.getint(CONFIG_SECTION, 'ping_duration_tcp_rtt')
         
         # config object for the web UI
         self.web_config = {
@@ -63,7 +140,8 @@ class Poller:
         self.config_manager = aprs2_config.ConfigManager(logging.getLogger('config'),
         	self.red,
         	self.config.get(CONFIG_SECTION, 'portal_servers_url'),
-        	self.config.get(CONFIG_SECTION, 'portal_rotates_url'))
+        	self.config.get(CONFIG_SECTION, 'portal_rotates_url'),
+        	address_prefixes = self.uplink_prefixes())
         self.config_manager.start()
         
         # thread limits
@@ -75,11 +153,79 @@ class Poller:
         self.software_type_cache = {}
         # cache for rate stats
         self.rates_cache = {}
+        # previous per-uplink packet counters
+        self.uplink_rates_cache = aprs2_poll.UplinkRateCache()
+        # which servers gave a TCP RTT estimate on last poll
+        self.tcp_rtt_cache = {}
+        # circuit breaker for servers which are down hard
+        self.breaker = aprs2_breaker.CircuitBreaker(self.log,
+            self.config.getint(CONFIG_SECTION, 'breaker_threshold'),
+            self.poll_interval,
+            self.config.getint(CONFIG_SECTION, 'breaker_backoff_max'))
+        
+        # network-wide uplink topology graph
+        self.topology = aprs2_topology.UplinkTopology(logging.getLogger('topology'), self.red,
+            max_age=self.poll_interval * 3,
+            hub_max_leaves=self.config.getint(CONFIG_SECTION, 'hub_max_leaves'))
+        self.topology.load()
         
-        # IP address => server ID map
-        self.address_map = {}
-        self.address_map_refresh_t = 0
-        self.address_map_refresh_int = 300
+        # In-memory snapshot of the server configuration, replaced as a whole
+        # when the config manager publishes a new config version. The version
+        # is also checked every now and then, in case a message was missed.
+        self.config_pubsub = self.red.subscribeConfig()
+        self.config_snapshot = self.config_manager.load_snapshot()
+        self.config_check_t = time.time()
+        self.config_check_int = 300
+        
+        # push poll results to the DNS driver
+        self.pusher = None
+        push_url = self.config.get(CONFIG_SECTION, 'push_url')
+        if push_url:
+            self.pusher = aprs2_push.StatusPusher(logging.getLogger('push'), push_url,
+                self.config.get(CONFIG_SECTION, 'push_site'),
+                self.config.get(CONFIG_SECTION, 'push_key'))
+        
+        self.metrics_setup()
+    
+    def metrics_setup(self):
+        """
+        Set up internal metrics, and start the metrics HTTP server
+        """
+        
+        aprs2_metrics.gauge('aprs2_poll_threads', 'Poll threads running', func=lambda: self.threads_now)
+        aprs2_metrics.gauge('aprs2_poll_threads_max', 'Maximum number of poll threads', func=lambda: self.threads_max)
+        self.m_queue_due = aprs2_metrics.gauge('aprs2_poll_queue_due', 'Servers due for polling')
+        self.m_schedule_lag = aprs2_metrics.gauge('aprs2_poll_schedule_lag_seconds', 'How late the most overdue poll is')
+        self.m_redis_rtt = aprs2_metrics.histogram('aprs2_redis_rtt_seconds', 'Redis round-trip time of the poll queue check',
+            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+        self.m_polls = aprs2_metrics.counter('aprs2_polls', 'Server polls completed: ok, fail, skipped (circuit breaker open) or probe_fail (only a failed connect check)', ('status',))
+        self.m_poll_t = aprs2_metrics.histogram('aprs2_poll_seconds', 'Duration of server polls')
+        self.m_log_json = aprs2_metrics.counter('aprs2_poll_log_history_json_bytes', 'Poll log history entries, uncompressed JSON size')
+        self.m_log_stored = aprs2_metrics.counter('aprs2_poll_log_history_stored_bytes', 'Poll log history entries, compressed size stored')
+        aprs2_metrics.counter('aprs2_log_dropped', 'Log records dropped due to a full log queue', func=self.log_queue.dropped)
+        aprs2_graphite.register_metrics()
+        if self.pusher:
+            aprs2_metrics.counter('aprs2_push_sent', 'Server statuses pushed to the DNS driver', func=lambda: self.pusher.pushed)
+            aprs2_metrics.counter('aprs2_push_failures', 'Failed pushes to the DNS driver', func=lambda: self.pusher.failures)
+        
+        listen = self.config.get(CONFIG_SECTION, 'metrics_listen')
+        if listen:
+            aprs2_metrics.start_server(self.log, listen)
+    
+    def uplink_prefixes(self):
+        """
+        Parse the uplink address prefix configuration
+        """
+        
+        prefixes = {}
+        for i in self.config.get(CONFIG_SECTION, 'uplink_prefixes').split():
+            prefix, sep, id = i.partition('=')
+            if not sep or not id:
+                self.log.error("Invalid uplink_prefixes entry, expected prefix=SERVERID: %r", i)
+                continue
+            prefixes[prefix] = id.upper()
+        
+        return prefixes
     
     def perform_poll(self, server):
         """
@@ -88,10 +234,15 @@ class Poller:
         
         # Use a separate log buffer for each poll, so that
         # we can store it in the database for easy lookup.
-        log = aprs2_logbuf.PollingLog(self.log_poller)
+        log = aprs2_logbuf.PollingLog(self.log_poller, self.poll_log_lines, self.poll_log_level)
         
         log.info("Poll thread started for %s", server['id'])
-        p = aprs2_poll.Poll(log, server, self.red, self.software_type_cache, self.rates_cache, self.address_map)
+        t_start = time.monotonic()
+        p = aprs2_poll.Poll(log, server, self.red, self.software_type_cache, self.rates_cache, self.config_snapshot,
+            poll_budget=self.poll_budget, breaker=self.breaker,
+            tcp_rtt_cache=self.tcp_rtt_cache, ping_duration=self.ping_duration,
+            ping_duration_tcp_rtt=self.ping_duration_tcp_rtt,
+            topology=self.topology, uplink_rates_cache=self.uplink_rates_cache)
         success = False
         try:
             success = p.poll()
@@ -102,6 +253,13 @@ class Poller:
         
         props = p.properties
         now = int(time.time())
+        if p.breaker_skipped:
+            self.m_polls.inc(status='skipped')
+        elif p.probe_failed:
+            self.m_polls.inc(status='probe_fail')
+        else:
+            self.m_poll_t.observe(time.monotonic() - t_start)
+            self.m_polls.inc(status='ok' if success == True else 'fail')
         
         state = self.red.getServerStatus(server['id'])
         if state == None:
@@ -144,16 +302,38 @@ class Poller:
         
         # store state in local database
         self.red.setServerStatus(server['id'], state)
-        self.red.storeServerLog(server['id'], { 't': now, 'log': log.buffer_string() })
+        log_entry = { 't': now, 'log': log.buffer_string() }
+        self.red.storeServerLog(server['id'], log_entry)
         self.red.sendServerStatusMessage({ 'config': server, 'status': state })
+        if self.pusher:
+            self.pusher.push(server, state)
+        
+        # the history is not essential, do it after the status has been published
+        if self.poll_log_history_len > 0:
+            try:
+                json_len, stored_len = self.red.appendServerLogHistory(server['id'], log_entry,
+                    self.poll_log_history_len, self.poll_log_history_age)
+                self.m_log_json.inc(json_len)
+                self.m_log_stored.inc(stored_len)
+                self.log.debug("%s: Poll log history: %d bytes JSON, %d bytes compressed",
+                    server['id'], json_len, stored_len)
+            except Exception as e:
+                self.log.error("%s: Failed to store poll log history: %r", server['id'], e)
         
         # push statistics (through a buffer and thread) to graphite
-        graphite_sender = aprs2_graphite.GraphiteSender(self.log, "server." + server["id"])
+        graphite_sender = aprs2_graphite.GraphiteSender(self.log, "server." + server["id"], now)
         graphite_sender.send('ok', 1 if state.get('status') == 'ok' else 0)
         graphite_sender.send('avail_3', state.get('avail_3', 0))
         for k in ('score','ping_loss', 'ping_rtt_avg', 'ping_rtt_max'):
             if k in props:
                 graphite_sender.send(k, props.get(k))
+        ups = props.get('uplinks', [])
+        if ups and 'rx_rate' in ups[0]:
+            graphite_sender.send('uplink_rx_rate', ups[0]['rx_rate'])
+        for probe, ti in props.get('tcp_rtt', {}).items():
+            graphite_sender.send('tcp_rtt.' + probe, ti.get('rtt'))
+        for stage, t in props.get('stage_t', {}).items():
+            graphite_sender.send('stage_t.' + stage, t)
 
     def poll(self, server):
         """
@@ -163,6 +343,9 @@ class Poller:
         
         thread = threading.Thread(target=self.perform_poll, args=(server,))
         thread.daemon = True
+        thread.poll_id = server['id']
+        thread.poll_started = time.monotonic()
+        thread.poll_overdue = False
         thread.start()
         self.threads.append(thread)
     
@@ -179,7 +362,10 @@ class Poller:
         
         while to_poll and self.threads_now < self.threads_max:
             i = to_poll.pop(0)
-            server = self.red.getServer(i)
+            server = self.config_snapshot.getServer(i)
+            if server == None:
+                # might have been added after the snapshot was taken
+                server = self.red.getServer(i)
             if server and not server.get('deleted'):
                 self.red.setPollQ(i, int(time.time()) + self.poll_interval)
                 self.poll(server)
@@ -187,6 +373,19 @@ class Poller:
                 self.log.info("Server %s has been removed, removing from queue.", i)
                 self.red.delPollQ(i)
     
+    def loop_queue_stats(self):
+        """
+        Update poll queue metrics, and measure Redis round-trip time while at it
+        """
+        
+        now = time.time()
+        t_start = time.monotonic()
+        due, oldest = self.red.getPollQueueStats(now)
+        self.m_redis_rtt.observe(time.monotonic() - t_start)
+        
+        self.m_queue_due.set(due)
+        self.m_schedule_lag.set(now - oldest if oldest != None else 0)
+    
     def loop_reap_old_threads(self):
         """
         Check which threads are still running.
@@ -202,21 +401,63 @@ class Poller:
                 #self.log.debug("* thread %d joined", th.ident)
                 self.threads_now -= 1
             else:
+                # Threads cannot be killed, but the polls observe their time budget
+                # and stop by themselves. Complain about ones which don't.
+                if not th.poll_overdue and time.monotonic() - th.poll_started > self.poll_budget + 30:
+                    self.log.error("* poll thread for %s has been running for %.0f s, over its time budget",
+                        th.poll_id, time.monotonic() - th.poll_started)
+                    th.poll_overdue = True
                 threads_left.append(th)
                 
         self.threads = threads_left
     
-    def load_address_map(self):
+    def load_config_snapshot(self):
+        """
+        Get a new configuration snapshot, if the configuration has changed.
+        If the database is not reachable, keep using the old snapshot, and
+        subscribe again on the next round.
+        """
+        
+        try:
+            changed = self.check_config_changed()
+            if changed:
+                self.log.info("Configuration changed, loading new snapshot")
+                self.config_snapshot = self.config_manager.load_snapshot()
+        except redis.exceptions.RedisError as e:
+            self.log.error("Failed to check for configuration changes, keeping the old snapshot: %r", e)
+            if self.config_pubsub != None:
+                try:
+                    self.config_pubsub.close()
+                except Exception:
+                    pass
+                self.config_pubsub = None
+    
+    def check_config_changed(self):
         """
-        Get a new address map, if necessary
+        Check for configuration change messages, and every now and then
+        the configuration version, in case a message was missed
         """
+        
+        changed = False
+        if self.config_pubsub == None:
+            # messages may have been missed while unsubscribed
+            self.config_pubsub = self.red.subscribeConfig()
+            self.config_check_t = 0
+        
+        while True:
+            msg = self.config_pubsub.get_message()
+            if msg == None:
+                break
+            if msg.get('type') == 'message':
+                changed = True
+        
         now = time.time()
-        if now > self.address_map_refresh_t or now < self.address_map_refresh_t - self.address_map_refresh_int:
-            self.log.info("Refreshing address map")
-            # Get a fresh address map
-            self.address_map = self.red.getAddressMap()
-            self.address_map_refresh_t = now + self.address_map_refresh_int
+        if now > self.config_check_t + self.config_check_int or now < self.config_check_t:
+            self.config_check_t = now
+            if self.red.getConfigVersion() != self.config_snapshot.version:
+                changed = True
         
+        return changed
     
     def loop(self):
         """
@@ -224,12 +465,14 @@ class Poller:
         """
         
         while True:
-            # consider reloading address_map
-            self.load_address_map()
+            # consider reloading configuration
+            self.load_config_snapshot()
             
             # reap old threads
             self.loop_reap_old_threads()
             
+            self.loop_queue_stats()
+            
             # start up new poll rounds, if thread limit allows
             if self.threads_now < self.threads_max:
                 self.loop_consider_polls()
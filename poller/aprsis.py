@@ -6,6 +6,8 @@ APRS-IS testing client for the purpose of checking if a server is working
 import socket
 import re
 
+import aprs2_tcpinfo
+
 re_prompt_port_full = re.compile('# Port full')
 re_prompt_server_full = re.compile('# Server full')
 re_login_ok = re.compile('# logresp ([^ ]+) ([^, ]+), server ([A-Z0-9\\-]+)')
@@ -15,6 +17,7 @@ class TCPPoll:
         self.log = log
         self.sock_timeout = 5
         self.mycall = 'APRS2N-ET'
+        self.tcp_info = None
     
     def poll(self, host, port, serverid, logkey):
         """
@@ -24,6 +27,7 @@ class TCPPoll:
         self.host = host
         self.port = port
         self.logkey = logkey
+        self.tcp_info = None
         
         self.log.info("%s: APRS-IS TCP test: %s port %s", self.id, host, port)
         
@@ -46,6 +50,7 @@ class TCPPoll:
             s.send(login_command.encode('ASCII'))
             login_ok = s.recv(1024).decode('UTF-8')
             self.log.debug('%s: Login response: %s', self.id, repr(login_ok))
+            self.tcp_info = aprs2_tcpinfo.tcp_info(s)
             s.close()
         except IOError as e:
             try:
@@ -0,0 +1,69 @@
+
+"""
+
+The NumPy and dict versions of rotate selection must give the same results.
+
+"""
+
+import pytest
+
+import aprs2_rotates
+
+def fixture():
+    servers = {
+        'A': { 'id': 'A', 'ipv4': '192.0.2.1', 'ipv6': '2001:db8::1' },
+        'B': { 'id': 'B', 'ipv4': '192.0.2.2' },
+        'C': { 'id': 'C', 'ipv4': '192.0.2.3', 'ipv6': '2001:db8::3' },
+        'D': { 'id': 'D', 'ipv4': '192.0.2.4', 'deleted': True },
+        'E': { 'id': 'E', 'ipv4': '192.0.2.5', 'out_of_service': True },
+        'F': { 'id': 'F', 'ipv4': '192.0.2.6' },
+        'G': { 'id': 'G', 'ipv4': '192.0.2.7', 'ipv6': '2001:db8::7' },
+    }
+    status = {
+        'A': { 'status': 'ok', 'score': 20.0, 'props': { 'worst_load': 20, 'clients': 10.5, 'rate_bytes_in': 100.0, 'rate_bytes_out': 200.0, 'submit-http-8080-ipv4': True } },
+        'B': { 'status': 'ok', 'score': 10.0, 'props': { 'worst_load': 20, 'clients': 3, 'rate_bytes_in': 50, 'rate_bytes_out': 60 } },
+        'C': { 'status': 'ok', 'score': 20.0, 'props': { 'clients': 2.25, 'worst_load': 10, 'submit-http-8080-ipv4': True } },
+        'D': { 'status': 'ok', 'score': 1.0, 'props': { 'clients': 100 } },
+        'E': { 'status': 'ok', 'score': 1.0, 'props': { 'clients': 100 } },
+        'F': { 'status': 'ok', 'score': 5.0, 'props': { 'clients': 7, 'worst_load': 95 } },
+        'G': { 'status': 'fail' },
+    }
+    rotates = {
+        'rotate.aprs2.net': { 'members': ['A', 'B', 'C', 'D', 'E', 'F', 'G'] },
+        # A and B listed twice, X is not a known server
+        'euro.aprs2.net': { 'members': ['C', 'A', 'B', 'A', 'X', 'B'] },
+        'empty.aprs2.net': { 'members': [] },
+    }
+    
+    return servers, status, rotates
+
+def test_dict_duplicates_float_clients():
+    servers, status, rotates = fixture()
+    selected, total = aprs2_rotates.select_rotates(rotates, status, servers, 'rotate.aprs2.net')
+    
+    euro = selected['euro.aprs2.net']
+    assert euro['members_ok'] == ['C', 'A', 'B']
+    # same score for C and A: configured order is kept
+    assert euro['order_v4'] == ['B', 'C', 'A']
+    assert euro['order_v6'] == ['C', 'A']
+    assert euro['stats'] == (16, 150.0, 260.0)
+    assert type(euro['stats'][0]) == int
+    
+    master = selected['rotate.aprs2.net']
+    assert master['members_not_deleted'] == ['A', 'B', 'C', 'E', 'F', 'G']
+    assert master['order_v4'] == ['A', 'C']
+    
+    assert total['members_ok'] == ['A', 'B', 'C', 'F']
+    assert total['stats'] == (23, 150.0, 260.0)
+
+def test_numpy_same_as_dict():
+    pytest.importorskip('numpy')
+    
+    servers, status, rotates = fixture()
+    by_dict = aprs2_rotates.select_rotates(rotates, status, servers, 'rotate.aprs2.net', use_numpy=False)
+    by_numpy = aprs2_rotates.select_rotates(rotates, status, servers, 'rotate.aprs2.net', use_numpy=True)
+    
+    assert by_numpy == by_dict
+    for domain in by_numpy[0]:
+        assert type(by_numpy[0][domain]['stats'][0]) == int
+    assert type(by_numpy[1]['stats'][0]) == int
@@ -0,0 +1,67 @@
+
+"""
+
+merge_status must not modify the fetched statuses, which are cached
+and merged again on later rounds.
+
+"""
+
+import os
+import copy
+import logging
+import importlib.util
+
+import pytest
+
+for mod in ('redis', 'requests', 'dns.update', 'CloudFlare'):
+    pytest.importorskip(mod)
+
+import aprs2_graphite
+
+def load_dns_driver():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aprs2net-dns.py')
+    spec = importlib.util.spec_from_file_location('aprs2net_dns', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class FakeRedis:
+    def __init__(self, prev_states):
+        self.prev_states = prev_states
+    
+    def getServerStatuses(self):
+        return copy.deepcopy(self.prev_states)
+    
+    def updateAvailMulti(self, updates):
+        return dict([(id, (99.0, 99.0)) for id, seconds, isUp in updates])
+    
+    def setServerStatuses(self, statuses):
+        pass
+
+class FakeGraphiteSender:
+    def __init__(self, log, fqdn, timestamp=None):
+        pass
+    
+    def send(self, metric, value, timestamp=None):
+        return True
+
+def test_merge_twice_same_score(monkeypatch):
+    monkeypatch.setattr(aprs2_graphite, 'GraphiteSender', FakeGraphiteSender)
+    
+    DNSDriver = load_dns_driver().DNSDriver
+    driver = DNSDriver.__new__(DNSDriver)
+    driver.log = logging.getLogger('test')
+    driver.poll_interval = 120
+    # availability below 99.98 % gives a score penalty
+    driver.red = FakeRedis({ 'T2TEST': { 'status': 'ok', 'last_test': 940, 'last_change': 100, 'avail_3': 99.0 } })
+    
+    servers = { 'T2TEST': { 'id': 'T2TEST' } }
+    # the same cached status set, as with fetch_cache, ETag reuse and pushes
+    status_set = { 'T2TEST': { 'site1': { 'status': 'ok', 'last_test': 1000, 'props': { 'score': 100.0 } } } }
+    
+    first = driver.merge_status(servers, status_set)['T2TEST']['score']
+    second = driver.merge_status(servers, status_set)['T2TEST']['score']
+    
+    assert first > 100.0
+    assert second == first
+    assert status_set['T2TEST']['site1']['props']['score'] == 100.0
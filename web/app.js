@@ -27,6 +27,9 @@ kWebConfig = 'aprs2.webconfig';
 kRotate = 'aprs2.rotate';
 kRotateStatus = 'aprs2.rotateStatus';
 kRotateStats = 'aprs2.rotateStats';
+kStatusSeq = 'aprs2.statusseq';
+kStatusChanges = 'aprs2.statuschanges';
+kStatusEpoch = 'aprs2.statusepoch';
 
 if (ops['dns_driver']) {
 	redis_dbid = 1;
@@ -135,45 +138,76 @@ function handle_full_status(req, res)
 
 function generate_full_status(req, res)
 {
-	red.hgetall(kServerStatus, function (err, stats) {
-		for (i in stats)
-			stats[i] = JSON.parse(stats[i]);
+	/* Get the change feed position first: changes made while the
+	 * full status is being collected will be sent again in the next
+	 * delta, which does no harm.
+	 */
+	red.mget([kStatusSeq, kStatusEpoch], function (err, seqs) {
+		var statusseq = status_seq(seqs);
 		
-		red.hgetall(kRotate, function (err, rots) {
-			for (i in rots)
-				rots[i] = JSON.parse(rots[i]);
+		red.hgetall(kServerStatus, function (err, stats) {
+			for (i in stats)
+				stats[i] = JSON.parse(stats[i]);
 			
-			red.hgetall(kServer, function (err, confs) {
-				if (ops['dns_driver']) {
-					red.get(kRotateStatus, function (err, rotstats) {
-						rotstats = JSON.parse(rotstats);
-						send_full_status(req, res, stats, rots, rotstats, confs);
-					});
-				} else {
-					send_full_status(req, res, stats, rots, null, confs);
-				}
+			red.hgetall(kRotate, function (err, rots) {
+				for (i in rots)
+					rots[i] = JSON.parse(rots[i]);
+				
+				red.hgetall(kServer, function (err, confs) {
+					if (ops['dns_driver']) {
+						red.get(kRotateStatus, function (err, rotstats) {
+							rotstats = JSON.parse(rotstats);
+							send_full_status(req, res, stats, rots, rotstats, confs, statusseq);
+						});
+					} else {
+						send_full_status(req, res, stats, rots, null, confs, statusseq);
+					}
+				});
 			});
 		});
 	});
 }
 
-function send_full_status(req, res, stats, rots, rotstats, confs)
+function status_seq(seqs)
+{
+	return {
+		'seq': (seqs && seqs[0]) ? parseInt(seqs[0]) : 0,
+		'epoch': (seqs && seqs[1]) ? seqs[1] : ''
+	};
+}
+
+/* parse a server config, and trim unnecessary elements from it,
+ * returns null for servers marked as deleted
+ */
+function trim_config(s)
+{
+	if (!s)
+		return null;
+	
+	var conf = JSON.parse(s);
+	// do not display servers marked as deleted
+	if (conf['deleted'])
+		return null;
+	
+	// trim unnecessary elements from JSON
+	delete conf['deleted'];
+	delete conf['host'];
+	delete conf['domain'];
+	if (!conf['out_of_service'])
+		delete conf['out_of_service'];
+	
+	return conf;
+}
+
+function send_full_status(req, res, stats, rots, rotstats, confs, statusseq)
 {
 	var a = [];
 
 	for (i in confs) {
-		var conf = JSON.parse(confs[i]);
-		// do not display servers marked as deleted
-		if (conf['deleted'])
+		var conf = trim_config(confs[i]);
+		if (!conf)
 			continue;
 		
-		// trim unnecessary elements from JSON
-		delete conf['deleted'];
-		delete conf['host'];
-		delete conf['domain'];
-		if (!conf['out_of_service'])
-			delete conf['out_of_service'];
-		
 		if (stats[i]) {
 			a.push({
 				'config': conf,
@@ -193,6 +227,7 @@ function send_full_status(req, res, stats, rots, rotstats, confs)
 				'seq': evq_seq,
 				'len': evq_len
 			},
+			'statusseq': statusseq,
 			'rotates': rots,
 			'rotatestat': rotstats,
 			'servers': a
@@ -200,6 +235,69 @@ function send_full_status(req, res, stats, rots, rotstats, confs)
 	});
 }
 
+/* Incremental status: servers whose status has changed since
+ * the given change feed sequence number, and the IDs of servers which
+ * have been removed. Falls back to a full status if the feed
+ * does not match (database wiped, or a bad sequence number).
+ */
+function handle_delta(req, res)
+{
+	util.log("delta req: " + JSON.stringify(req.query));
+	
+	var since = parseInt(req.query['since']);
+	var epoch = req.query['epoch'];
+	
+	red.mget([kStatusSeq, kStatusEpoch], function (err, seqs) {
+		var statusseq = status_seq(seqs);
+		
+		if (err || isNaN(since) || since > statusseq['seq'] || epoch != statusseq['epoch']) {
+			util.log("delta: change feed mismatch, sending full status");
+			generate_full_status(req, res);
+			return;
+		}
+		
+		red.zrangebyscore(kStatusChanges, '(' + since, statusseq['seq'], function (err, ids) {
+			if (err || !ids || ids.length == 0) {
+				send_delta(req, res, statusseq, [], []);
+				return;
+			}
+			
+			red.hmget([kServerStatus].concat(ids), function (err, stats) {
+				red.hmget([kServer].concat(ids), function (err, confs) {
+					var a = [];
+					var deleted = [];
+					
+					for (var i = 0; i < ids.length; i++) {
+						var conf = trim_config(confs[i]);
+						if (!conf || !stats[i]) {
+							deleted.push(ids[i]);
+							continue;
+						}
+						
+						a.push({
+							'config': conf,
+							'status': JSON.parse(stats[i])
+						});
+					}
+					
+					send_delta(req, res, statusseq, a, deleted);
+				});
+			});
+		});
+	});
+}
+
+function send_delta(req, res, statusseq, servers, deleted)
+{
+	res.setHeader('Cache-Control', 'no-cache');
+	res.json({
+		'result': 'delta',
+		'statusseq': statusseq,
+		'servers': servers,
+		'deleted': deleted
+	});
+}
+
 var handle_upd = function(req, res) {
 	util.log("upd req: " + JSON.stringify(req.query));
 	
@@ -321,6 +419,11 @@ function init() {
 	/* Set up the express app */
 	var app = express();
 	app.configure(function() {
+		/* gzip/deflate responses for clients which ask for it; express
+		 * sets an ETag on the JSON responses, and answers 304 Not Modified
+		 * to If-None-Match requests when nothing has changed.
+		 */
+		app.use(express.compress());
 		app.use(express.bodyParser());
 		app.use(express.methodOverride());
 		app.use(app.router);
@@ -330,6 +433,7 @@ function init() {
 
 	app.get('/api/full', handle_full_status); /* fetch full server list */
 	app.get('/api/upd', handle_upd); /* fetch updates to servers */
+	app.get('/api/delta', handle_delta); /* fetch servers changed since a change feed position */
 	app.get('/api/slog', handle_slog); /* fetch a poll log of a server */
 	app.get('/api/rstats', handle_rstats); /* fetch a poll log of a server */
 	